@@ -0,0 +1,193 @@
+"""
+Compile-throughput benchmarks.
+
+Generates synthetic programs of increasing size in a few different
+shapes, runs every compiler stage over them and reports lines/second
+per stage and overall, against the SLO from the README.
+
+    poetry run python bench/compile.py -o bench-compile.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import llvmlite
+
+from lang.compiler import compile_main
+from lang.llvm import init_llvm, compile_execution_engine, compile_ir
+from lang.parser import parse
+from lang.simplify import simplify
+
+# JAI's compile speed, see README.org.
+TARGET_LINES_PER_SECOND = 104000
+
+PRELUDE = '''(declare print_value void (value))
+(declare value_truthy bool (value))
+
+'''
+
+def gen_defuns(n):
+    """Many small functions, each called once."""
+    lines = [PRELUDE]
+    for i in range(n):
+        lines.append('(defun f{} (x y)\n  (+ (* x {}) y))\n'.format(i, i))
+        lines.append('(print_value (f{} {} 2))\n'.format(i, i))
+    return ''.join(lines)
+
+def gen_nesting(n, depth=40):
+    """Deeply nested let & if forms."""
+    lines = [PRELUDE]
+    for i in range(max(1, n // (2 * depth))):
+        for d in range(depth):
+            indent = '  ' * d
+            if d % 2:
+                lines.append('{}(if (< x{} {})\n'.format(indent, d - 1, i))
+            else:
+                lines.append('{}(let ((x{} {}))\n'.format(indent, d, d))
+        lines.append('  ' * depth + '(print_value x0)')
+        for d in reversed(range(depth)):
+            if d % 2:
+                lines.append('\n' + '  ' * d + '  x{})'.format(d - 1))
+            else:
+                lines.append(')')
+        lines.append('\n')
+    return ''.join(lines)
+
+def gen_strings(n, length=400):
+    """Long string literals."""
+    lines = [PRELUDE]
+    for i in range(n):
+        text = ('lorem ipsum {} '.format(i) * length)[:length]
+        lines.append('(print_value "{}\\n")\n'.format(text))
+    return ''.join(lines)
+
+def gen_progn(n):
+    """One big flat progn."""
+    lines = [PRELUDE, '(progn\n']
+    for i in range(n):
+        lines.append('  (print_value {})\n'.format(i))
+    lines.append('  nil)\n')
+    return ''.join(lines)
+
+SHAPES = {
+    'defuns': gen_defuns,
+    'nesting': gen_nesting,
+    'strings': gen_strings,
+    'progn': gen_progn,
+}
+
+def run_stages(engine, source):
+    """
+    Run the compiler pipeline over source, returning a dict of stage
+    name to seconds.
+    """
+    timings = {}
+    start = time.perf_counter()
+    _, ast = parse(source)
+    timings['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ast, _ = simplify(ast)
+    timings['simplify'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    module = compile_main(ast)
+    timings['compile_main'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    llvm_ir = str(module)
+    timings['str(module)'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compile_ir(engine, llvm_ir)
+    timings['compile_ir'] = time.perf_counter() - start
+    return timings
+
+def bench(shapes, sizes, repeat):
+    init_llvm()
+    results = []
+    for shape in shapes:
+        for size in sizes:
+            source = SHAPES[shape](size)
+            lines = source.count('\n')
+            best = None
+            for _ in range(repeat):
+                # A fresh engine each time so modules don't accumulate.
+                timings = run_stages(compile_execution_engine(), source)
+                if best is None:
+                    best = timings
+                else:
+                    best = {k: min(v, timings[k]) for k, v in best.items()}
+            total = sum(best.values())
+            result = {
+                'shape': shape,
+                'size': size,
+                'lines': lines,
+                'seconds': best,
+                'lines_per_second': {k: lines / v for k, v in best.items()},
+                'total_seconds': total,
+                'total_lines_per_second': lines / total,
+            }
+            results.append(result)
+            print('{:>8} {:>6} {:>7} lines  {}  total {:>9.0f} l/s'.format(
+                shape, size, lines,
+                '  '.join('{} {:>9.0f}'.format(k, v)
+                          for k, v in result['lines_per_second'].items()),
+                result['total_lines_per_second']))
+    return results
+
+def compare(previous, results):
+    """Print per-stage throughput changes against a previous run."""
+    old = {(r['shape'], r['size']): r for r in previous['results']}
+    for r in results:
+        o = old.get((r['shape'], r['size']))
+        if o is None:
+            continue
+        changes = []
+        for stage, lps in r['lines_per_second'].items():
+            if stage in o['lines_per_second']:
+                delta = lps / o['lines_per_second'][stage] - 1
+                changes.append('{} {:+.1%}'.format(stage, delta))
+        print('{:>8} {:>6}  {}'.format(r['shape'], r['size'], '  '.join(changes)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-o', '--output', default='bench-compile.json',
+                        help='where to write the JSON results')
+    parser.add_argument('--shapes', nargs='+', default=list(SHAPES),
+                        choices=list(SHAPES))
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[100, 1000])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='best of N runs per program')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='previous results to diff against')
+    args = parser.parse_args()
+
+    results = bench(args.shapes, args.sizes, args.repeat)
+    lines = sum(r['lines'] for r in results)
+    seconds = sum(r['total_seconds'] for r in results)
+    overall = lines / seconds
+    print('overall: {:.0f} lines/second (target {})'.format(
+        overall, TARGET_LINES_PER_SECOND))
+
+    with open(args.output, 'w') as fp:
+        json.dump({
+            'python': platform.python_version(),
+            'llvmlite': llvmlite.__version__,
+            'timestamp': time.time(),
+            'target_lines_per_second': TARGET_LINES_PER_SECOND,
+            'overall_lines_per_second': overall,
+            'results': results,
+        }, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), results)
+
+    return 0 if overall >= TARGET_LINES_PER_SECOND else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,15 @@
+;; Calls through first-class function values.
+
+(declare print_value void (value))
+(declare value_truthy bool (value))
+
+(defun add (a b) (+ a b))
+(defun sub (a b) (- a b))
+
+(defun apply-n (f g n acc)
+  (if (< 0 n)
+      (recur g f (- n 1) (f acc n))
+      acc))
+
+(print_value (apply-n add sub 500000 0))
+(print_value "\n")
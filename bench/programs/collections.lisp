@@ -0,0 +1,29 @@
+;; Lookups in vector & hash map literals, and building a hash map
+;; with value_assoc.
+
+(declare print_value void (value))
+(declare value_get value (value value))
+(declare value_assoc value (value value value))
+(declare value_count value (value))
+
+(def primes [2 3 5 7 11 13 17 19 23 29 31 37 41 43 47 53])
+
+(def names {:one 1 :two 2 :three 3 :four 4 :five 5 :six 6 :seven 7
+            :eight 8 :nine 9 :ten 10 "eleven" 11 "twelve" 12})
+
+(defun lookups (n acc)
+  (if (< 0 n)
+      (recur (- n 1)
+             (+ acc (+ (value_get primes (- n (* 16 (/ n 16))))
+                       (value_get names :seven))))
+      acc))
+
+(defun squares (m i)
+  (if (< i 2000)
+      (recur (value_assoc m i (* i i)) (+ i 1))
+      m))
+
+(print_value (lookups 200000 0))
+(print_value "\n")
+(print_value (value_get (squares {} 0) 1999))
+(print_value "\n")
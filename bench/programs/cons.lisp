@@ -0,0 +1,29 @@
+;; Building a cons list and folding it with reduce.
+
+(declare print_value void (value))
+(declare value_truthy bool (value))
+(declare value_equal value (value value))
+(declare car value (value))
+(declare cdr value (value))
+
+(defun nil? (x)
+  (value_equal nil x))
+
+(defun range (n acc)
+  (if (< 0 n)
+      (recur (- n 1) (cons n acc))
+      acc))
+
+(defun reduce (f acc l)
+  (if (nil? l)
+      acc
+      (recur f (f acc (car l)) (cdr l))))
+
+(defun repeat (times acc)
+  (if (< 0 times)
+      (recur (- times 1)
+             (+ acc (reduce (lambda (a b) (+ a (/ b 100))) 0 (range 20000 nil))))
+      acc))
+
+(print_value (repeat 20 0))
+(print_value "\n")
@@ -0,0 +1,18 @@
+;; Many small calls into the runtime through declared functions.
+
+(declare print_value void (value))
+(declare value_truthy bool (value))
+(declare value_equal value (value value))
+(declare type value (value))
+(declare hash i64 (string))
+
+(defun churn (n acc)
+  (if (< 0 n)
+      (recur (- n 1)
+             (if (value_equal (type n) (type acc))
+                 (+ acc (/ (hash "benchmark") 1000000000000))
+                 acc))
+      acc))
+
+(print_value (churn 300000 0))
+(print_value "\n")
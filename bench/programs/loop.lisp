@@ -0,0 +1,20 @@
+;; A tight recur loop over native ints. The bound is a global, so the
+;; loop can't be evaluated at compile time.
+
+(declare print_value void (value))
+(declare value_truthy bool (value))
+
+(def n 100000)
+
+(defun sum-to (i n acc)
+  (if (< i n)
+      (recur (+ i 1) n (+ acc (* i 3)))
+      acc))
+
+(defun repeat (times n acc)
+  (if (< 0 times)
+      (recur (- times 1) n (+ acc (sum-to 0 n 0)))
+      acc))
+
+(print_value (repeat 20 n 0))
+(print_value "\n")
@@ -0,0 +1,43 @@
+;; String & char processing: splitting strings into chars, classifying
+;; and joining them back together.
+
+(declare print_value void (value))
+(declare value_truthy bool (value))
+(declare value_equal value (value value))
+(declare car value (value))
+(declare cdr value (value))
+(declare string_to_cons value (value))
+(declare cons_to_string value (value))
+(declare concat_strings value (value value))
+
+(defun nil? (x)
+  (value_equal nil x))
+
+(defun alpha? (c)
+  (if (< c \a) (if (< c \A) false (< c \[)) (< c \{)))
+
+(defun count-alpha (l acc)
+  (if (nil? l)
+      acc
+      (recur (cdr l) (if (alpha? (car l)) (+ acc 1) acc))))
+
+(defun reverse (l acc)
+  (if (nil? l)
+      acc
+      (recur (cdr l) (cons (car l) acc))))
+
+(def text "The quick brown fox jumps over the lazy dog, 42 times! ")
+
+(defun repeat (times acc s)
+  (if (< 0 times)
+      (let ((chars (string_to_cons text)))
+        (recur (- times 1)
+               (+ acc (count-alpha chars 0))
+               (concat_strings text (cons_to_string (reverse chars nil)))))
+      (progn
+        (print_value s)
+        (print_value "\n")
+        acc)))
+
+(print_value (repeat 5000 0 ""))
+(print_value "\n")
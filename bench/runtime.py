@@ -0,0 +1,235 @@
+"""
+Runtime performance benchmarks.
+
+Compiles every program in bench/programs at each optimisation level,
+and runs it repeatedly in-process through the JIT, with the runtime
+loaded as a shared library, as an AOT binary linked against the
+runtime objects, and as a binary with the runtime's bitcode linked
+into the program before optimising. Reports mean time & standard
+deviation per program, level and mode, and checks all modes print the
+same.
+
+    make libnebula.so nebula.o rbb.o runtime.bc
+    poetry run python bench/runtime.py -o bench-runtime.json
+"""
+import argparse
+import ctypes
+import glob
+import json
+import os
+import platform
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import llvmlite
+
+from lang.compiler import compile_main
+from lang.evaluate import evaluate
+from lang.llvm import (llvm, compile_execution_engine, compile_ir,
+                       compile_module, compile_target_machine, emit)
+from lang.parser import parse
+from lang.simplify import simplify
+
+PROGRAMS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'programs')
+
+def load(path, level):
+    """Parses & simplifies a program like lang does at level."""
+    with open(path) as fp:
+        _, ast = parse(fp.read())
+    ast, _ = simplify(ast)
+    if '0' != level:
+        ast, _ = evaluate(ast)
+    return ast
+
+libc = ctypes.CDLL(None)
+
+def run_forked(fn, path):
+    """
+    Runs fn in a forked child with stdout going to path, which catches
+    output from JIT compiled code as well. Returns the seconds fn took.
+
+    The runtime never frees anything, so every run gets a fresh copy
+    of the heap, like a binary would.
+    """
+    sys.stdout.flush()
+    r, w = os.pipe()
+    pid = os.fork()
+    if 0 == pid:
+        os.close(r)
+        with open(path, 'wb') as fp:
+            os.dup2(fp.fileno(), 1)
+        start = time.perf_counter()
+        fn()
+        libc.fflush(None)
+        os.write(w, str(time.perf_counter() - start).encode('utf8'))
+        os._exit(0)
+    os.close(w)
+    with os.fdopen(r, 'rb') as fp:
+        seconds = fp.read()
+    _, status = os.waitpid(pid, 0)
+    if 0 != status:
+        raise Exception('JIT run failed with status {}'.format(status))
+    return float(seconds)
+
+def bench_jit(ast, level, repeat, directory):
+    """
+    Runs a program through the JIT. Returns a list of seconds per
+    run and the output of the first one.
+    """
+    engine = compile_execution_engine()
+    compile_ir(engine, str(compile_main(ast)), level)
+    # Not main, as the runtime's main calls back into usercode_main,
+    # which it can't see in the JIT.
+    usercode_main = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int,
+                                     ctypes.POINTER(ctypes.c_char_p))(
+        engine.get_function_address('usercode_main'))
+    argv = (ctypes.c_char_p * 1)(b'bench')
+    output = os.path.join(directory, 'jit.txt')
+    times = [run_forked(lambda: usercode_main(1, argv), output)
+             for _ in range(repeat)]
+    with open(output, 'rb') as fp:
+        return times, fp.read()
+
+def link_flags(llvm_config):
+    """The flags to link a binary against the runtime, as in the Makefile."""
+    flags = subprocess.run(
+        [llvm_config, '--ldflags', '--libs', 'core', 'executionengine',
+         'interpreter', 'mcjit', 'x86', '--system-libs'],
+        check=True, stdout=subprocess.PIPE).stdout.decode('utf8')
+    return ['-lffi'] + shlex.split(flags)
+
+def bench_aot(ast, level, repeat, directory, linker, objects, flags,
+              runtime=None):
+    """
+    Compiles a program to a binary & runs it, with the runtime's
+    bitcode linked in if given. Returns a list of seconds per run and
+    the output of the first one.
+    """
+    target_machine = compile_target_machine(level)
+    mod = compile_module(str(compile_main(ast)), level, target_machine,
+                         runtime=runtime)
+    obj = os.path.join(directory, 'bench.o')
+    binary = os.path.join(directory, 'bench')
+    with open(obj, 'wb') as fp:
+        fp.write(emit(target_machine, mod, 'obj'))
+    subprocess.run([linker, '-o', binary, obj] + objects + flags, check=True)
+    times = []
+    output = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([binary], check=True, stdout=subprocess.PIPE)
+        times.append(time.perf_counter() - start)
+        output = output or result.stdout
+    return times, output
+
+def summarise(times):
+    return {
+        'seconds': times,
+        'mean_seconds': statistics.mean(times),
+        'stdev_seconds': statistics.pstdev(times),
+        'min_seconds': min(times),
+    }
+
+def bench(programs, levels, modes, repeat, args):
+    results = []
+    flags = None
+    if set(modes) & set(['aot', 'linked']):
+        flags = link_flags(args.llvm_config)
+    with tempfile.TemporaryDirectory() as directory:
+        for path in programs:
+            name = os.path.splitext(os.path.basename(path))[0]
+            for level in levels:
+                ast = load(path, level)
+                outputs = dict()
+                for mode in modes:
+                    if 'jit' == mode:
+                        times, outputs[mode] = bench_jit(
+                            ast, level, repeat, directory)
+                    elif 'aot' == mode:
+                        times, outputs[mode] = bench_aot(
+                            ast, level, repeat, directory, args.linker,
+                            args.runtime_objects, flags)
+                    else:
+                        times, outputs[mode] = bench_aot(
+                            ast, level, repeat, directory, args.linker,
+                            [], flags, args.runtime_bitcode)
+                    result = dict(program=name, level=level, mode=mode,
+                                  **summarise(times))
+                    results.append(result)
+                    print('{:>8} -O{} {:>6}  mean {:>8.1f} ms  stdev {:>6.1f} ms'
+                          '  min {:>8.1f} ms'.format(
+                              name, level, mode, result['mean_seconds'] * 1000,
+                              result['stdev_seconds'] * 1000,
+                              result['min_seconds'] * 1000))
+                if 1 < len(set(outputs.values())):
+                    print('{:>8} -O{}  outputs differ between modes'.format(
+                        name, level), file=sys.stderr)
+    return results
+
+def compare(previous, results):
+    """Print mean time changes against a previous run."""
+    old = {(r['program'], r['level'], r['mode']): r
+           for r in previous['results']}
+    for r in results:
+        o = old.get((r['program'], r['level'], r['mode']))
+        if o is None:
+            continue
+        delta = r['mean_seconds'] / o['mean_seconds'] - 1
+        print('{:>8} -O{} {:>6}  {:+.1%}'.format(
+            r['program'], r['level'], r['mode'], delta))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-o', '--output', default='bench-runtime.json',
+                        help='where to write the JSON results')
+    parser.add_argument('--programs', nargs='+',
+                        default=sorted(glob.glob(os.path.join(PROGRAMS, '*.lisp'))),
+                        help='the programs to run (default: bench/programs)')
+    parser.add_argument('--levels', nargs='+', default=['0', '1', '2'],
+                        help='optimisation levels to compile at')
+    parser.add_argument('--modes', nargs='+', default=['jit', 'aot', 'linked'],
+                        choices=['jit', 'aot', 'linked'])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per program, level & mode')
+    parser.add_argument('--runtime', default='./libnebula.so',
+                        help='the runtime shared library, for the JIT '
+                        '(default: %(default)s)')
+    parser.add_argument('--runtime-objects', nargs='+',
+                        default=['nebula.o', 'rbb.o'],
+                        help='the runtime objects, for AOT binaries '
+                        '(default: %(default)s)')
+    parser.add_argument('--runtime-bitcode', default='runtime.bc',
+                        help='the runtime as bitcode, for linked binaries '
+                        '(default: %(default)s)')
+    parser.add_argument('--linker', default=os.environ.get('LD', 'clang++'),
+                        help='the linker for AOT binaries (default: $LD or '
+                        'clang++)')
+    parser.add_argument('--llvm-config', default='llvm-config')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='previous results to diff against')
+    args = parser.parse_args()
+
+    if 'jit' in args.modes:
+        llvm.load_library_permanently(os.path.abspath(args.runtime))
+        ctypes.CFUNCTYPE(None)(llvm.address_of_symbol('init_nebula'))()
+    results = bench(args.programs, args.levels, args.modes, args.repeat, args)
+
+    with open(args.output, 'w') as fp:
+        json.dump({
+            'python': platform.python_version(),
+            'llvmlite': llvmlite.__version__,
+            'timestamp': time.time(),
+            'results': results,
+        }, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Start-up benchmarks.
+
+Runs lang as a fresh process on tiny programs, where start-up is all
+there is to it, and reports the time until the output file is written
+for every output kind.
+
+    poetry run python bench/startup.py -o bench-startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROGRAMS = {
+    'empty': '',
+    'minimal': '''(declare print_value void (value))
+
+(print_value "hello")
+''',
+}
+
+KINDS = ['ll', 'bc', 'obj']
+
+# Runs lang like the poetry script does.
+LANG = [sys.executable, '-c', 'import lang; lang.main()']
+
+def time_run(argv, output):
+    """Runs a command, returns the seconds until output exists."""
+    if os.path.exists(output):
+        os.unlink(output)
+    start = time.perf_counter()
+    subprocess.run(argv, check=True)
+    seconds = time.perf_counter() - start
+    if not os.path.exists(output):
+        raise Exception('{} did not write {}'.format(' '.join(argv), output))
+    return seconds
+
+def bench(programs, kinds, repeat, directory):
+    results = []
+    # The floor: starting the interpreter & doing nothing.
+    output = os.path.join(directory, 'python')
+    argv = [sys.executable, '-c', 'import sys; open(sys.argv[1], "w")', output]
+    python = [time_run(argv, output) for _ in range(repeat)]
+    print('{:>8} {:>4}  median {:>7.1f} ms  stdev {:>5.1f} ms'.format(
+        'python', '', statistics.median(python) * 1000,
+        statistics.pstdev(python) * 1000))
+    for name in programs:
+        source = os.path.join(directory, name + '.lisp')
+        with open(source, 'w') as fp:
+            fp.write(PROGRAMS[name])
+        for kind in kinds:
+            output = os.path.join(directory, name + '.' + kind)
+            argv = LANG + ['--emit', kind, '-o', output, source]
+            times = [time_run(argv, output) for _ in range(repeat)]
+            result = {
+                'program': name,
+                'kind': kind,
+                'seconds': times,
+                'median_seconds': statistics.median(times),
+                'min_seconds': min(times),
+            }
+            results.append(result)
+            print('{:>8} {:>4}  median {:>7.1f} ms  stdev {:>5.1f} ms'.format(
+                name, kind, result['median_seconds'] * 1000,
+                statistics.pstdev(times) * 1000))
+    return statistics.median(python), results
+
+def compare(previous, results):
+    """Print median changes against a previous run."""
+    old = {(r['program'], r['kind']): r for r in previous['results']}
+    for r in results:
+        o = old.get((r['program'], r['kind']))
+        if o is None:
+            continue
+        delta = r['median_seconds'] / o['median_seconds'] - 1
+        print('{:>8} {:>4}  {:+.1%}'.format(r['program'], r['kind'], delta))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-o', '--output', default='bench-startup.json',
+                        help='where to write the JSON results')
+    parser.add_argument('--programs', nargs='+', default=list(PROGRAMS),
+                        choices=list(PROGRAMS))
+    parser.add_argument('--kinds', nargs='+', default=KINDS, choices=KINDS)
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='runs per program & output kind')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='previous results to diff against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        python, results = bench(args.programs, args.kinds, args.repeat,
+                                directory)
+
+    with open(args.output, 'w') as fp:
+        json.dump({
+            'python': platform.python_version(),
+            'timestamp': time.time(),
+            'python_startup_seconds': python,
+            'results': results,
+        }, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), results)
+
+if __name__ == '__main__':
+    main()
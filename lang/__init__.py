@@ -1,27 +1,201 @@
+import argparse
 import sys
 
-from lang.compiler import compile_main, compile_ir
-from lang.debug import debug
-from lang.llvm import init_llvm, compile_execution_engine
+from lang import conf
+from lang.compiler import compile_main
+from lang.debug import debug, timer
+from lang.llvm import (EMIT_KINDS, OPT_LEVELS, emit, compile_target_machine,
+                       compile_module, optimise_linked, prepare_module)
 from lang.parser import parse
+from lang.simplify import simplify
 
 __version__ = '0.1.0'
 
-def main():
-    init_llvm()
-    engine = compile_execution_engine()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='lang')
+    parser.add_argument('source_file', nargs='?',
+                        help='file to compile, or to load into the REPL')
+    parser.add_argument('program_args', nargs='*', metavar='arg',
+                        help='arguments for the program, with --run, after '
+                        '-- if any of them start with -')
+    parser.add_argument('-O', dest='opt_level', choices=list(OPT_LEVELS),
+                        default=conf.OPTIMISE,
+                        help='optimisation level, 1 is the fast development '
+                        'pipeline, 2 & 3 the full release one')
+    parser.add_argument('--emit', action='append', choices=list(EMIT_KINDS),
+                        help='what to output, can be given several times '
+                        '(default: obj)')
+    parser.add_argument('-o', dest='output',
+                        help='output file, when emitting only one kind')
+    parser.add_argument('--cache-dir',
+                        help='compile incrementally, caching compiled '
+                        'top-level forms in this directory')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='compile top-level forms in parallel, in this '
+                        'many processes')
+    parser.add_argument('--stream', action='store_true',
+                        help='parse & compile the source one top-level form '
+                        'at a time, so memory does not grow with it; '
+                        'functions are only called directly after they are '
+                        'defined, and there is no compile-time evaluation')
+    parser.add_argument('--memoise', action='store_true',
+                        help='memoise pure functions which recurse or loop, '
+                        'with lookup tables precomputed at compile time')
+    parser.add_argument('--minimal', action='store_true',
+                        help='compile the whole program only, dropping '
+                        'every function & global main does not reach, to '
+                        'link against the minimal runtime')
+    parser.add_argument('--runtime-bitcode', metavar='FILE',
+                        help='link the runtime from this bitcode (or IR) '
+                        'file into the program, so it can be inlined, see '
+                        'the runtime.bc make target; the output is then '
+                        'linked without the runtime objects')
+    parser.add_argument('--time-phases', action='store_true',
+                        help='report time & memory used by each phase')
+    parser.add_argument('--repl', action='store_true',
+                        help='start a REPL, which JIT compiles & runs '
+                        'every form entered')
+    parser.add_argument('--run', action='store_true',
+                        help='JIT compile & run the program, instead of '
+                        'writing an object file')
+    parser.add_argument('--runtime', default='./libnebula.so',
+                        help='the runtime shared library for the REPL & '
+                        '--run (default: %(default)s)')
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Everything after -- goes to the program as is.
+    program_args = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, program_args = argv[:split], argv[split + 1:]
+    # Intermixed, so program arguments can come after flags, which
+    # follow the source file.
+    args = parser.parse_intermixed_args(argv)
+    args.program_args += program_args
+    if not args.repl and not args.source_file:
+        parser.error('a source file is required, unless using --repl')
+    if args.stream and (args.memoise or args.minimal):
+        parser.error('--stream can not be used with --memoise or --minimal, '
+                     'which need the whole program')
+    if args.program_args and not args.run:
+        parser.error('program arguments can only be used with --run')
+    # Running needs no output files, unless asked for.
+    args.emit = args.emit or ([] if args.run else ['obj'])
+    if args.output and 1 < len(args.emit):
+        parser.error('-o can only be used with a single --emit')
+    return args
+
+def count_module(module):
+    """Count defined functions & basic blocks for the phase report."""
+    functions = [f for f in module.functions if not f.is_declaration]
+    timer.count('functions', len(functions))
+    timer.count('basic blocks', sum(len(f.blocks) for f in functions))
+
+def build(args, target_machine):
+    """
+    Compiles the source file and writes every kind of output asked
+    for. Returns the compiled module object.
+    """
+    if args.stream:
+        mod = build_stream(args, target_machine)
+        write_outputs(args, target_machine, mod)
+        return mod
     ast = None
-    source_file = sys.argv[1]
-    with open(source_file, 'r') as fp:
-        _, ast = parse(fp.read())
+    source_file = args.source_file
+    with timer.phase('parse'):
+        with open(source_file, 'r') as fp:
+            _, ast = parse(fp.read())
+    timer.count('top-level forms', len(ast))
+    with timer.phase('simplify'):
+        ast, removed = simplify(ast)
+    timer.count('simplified nodes', removed)
+    if '0' != args.opt_level:
+        from lang.evaluate import evaluate
+        with timer.phase('evaluate'):
+            ast, evaluated = evaluate(ast)
+        timer.count('evaluated calls', evaluated)
+    if args.minimal:
+        from lang.shake import drop_unreachable
+        with timer.phase('shake'):
+            ast, dropped = drop_unreachable(ast)
+        timer.count('dropped forms', dropped)
+    memo = None
+    if args.memoise:
+        from lang.memo import memo_tables
+        with timer.phase('memo tables'):
+            memo = memo_tables(ast)
+        timer.count('memoised functions', len(memo))
     debug(ast)
-    main_mod = compile_main(ast)
-    debug(main_mod)
-    # debug(main_mod)
-    with open(source_file.split('.')[0].split('/')[-1] + '.ll', 'w') as llvm_ir:
-        llvm_ir.write(str(main_mod))
-        llvm_ir.flush()
-    main_mod = compile_ir(engine, str(main_mod))
+    if args.cache_dir or 1 < args.jobs:
+        from lang.units import Cache, compile_units
+        cache = Cache(args.cache_dir) if args.cache_dir else None
+        mod = compile_units(ast, cache, args.opt_level, args.jobs, memo)
+        # Units are already optimised, but not across each other. That
+        # happens once, after linking in the runtime & minimising, so
+        # it also covers those.
+        mod = prepare_module(mod, '0', target_machine, args.minimal,
+                             args.runtime_bitcode)
+        optimise_linked(mod, args.opt_level)
+        if cache:
+            print('cache: {} hits, {} misses'.format(cache.hits, cache.misses),
+                  file=sys.stderr)
+    else:
+        with timer.phase('compile'):
+            main_mod = compile_main(ast, memo)
+        count_module(main_mod)
+        debug(main_mod)
+        with timer.phase('stringify IR'):
+            llvm_ir = str(main_mod)
+        mod = compile_module(llvm_ir, args.opt_level, target_machine,
+                             args.minimal, args.runtime_bitcode)
+    write_outputs(args, target_machine, mod)
+    return mod
+
+def build_stream(args, target_machine):
+    """Compiles the source file form by form, see lang.units.compile_stream."""
+    from lang.parser import parse_forms
+    from lang.simplify import simplify_forms
+    from lang.units import Cache, compile_stream
+    cache = Cache(args.cache_dir) if args.cache_dir else None
+    with open(args.source_file, 'r') as fp:
+        mod = compile_stream(simplify_forms(parse_forms(fp)), cache,
+                             args.opt_level, args.jobs)
+    if cache:
+        print('cache: {} hits, {} misses'.format(cache.hits, cache.misses),
+              file=sys.stderr)
+    # As for units in build.
+    mod = prepare_module(mod, '0', target_machine, False, args.runtime_bitcode)
+    optimise_linked(mod, args.opt_level)
+    return mod
+
+def write_outputs(args, target_machine, mod):
+    """Writes every kind of output asked for."""
+    base_name = args.source_file.split('.')[0].split('/')[-1]
+    for kind in args.emit:
+        output = emit(target_machine, mod, kind)
+        with open(args.output or base_name + EMIT_KINDS[kind], 'wb') as fp:
+            fp.write(output)
+
+def main():
+    args = parse_args()
+    if args.time_phases:
+        timer.enable()
+    if args.repl:
+        from lang.repl import repl
+        return repl(args.runtime, args.opt_level, args.source_file)
+    if args.run:
+        from lang.run import run
+        target_machine = None
+        if args.emit:
+            target_machine = compile_target_machine(args.opt_level)
+        mod = build(args, target_machine)
+        status = run(mod, args.runtime,
+                     [args.source_file] + args.program_args)
+        timer.report()
+        sys.exit(status)
+    # Output is only ever written to files, so there is no need for a
+    # JIT engine, nor to generate machine code for it.
+    build(args, compile_target_machine(args.opt_level))
+    timer.report()
 
 if __name__ == '__main__':
     main()
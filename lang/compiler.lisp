@@ -215,7 +215,11 @@
            false))
 
 (defun in? (elm l)
-  (any? (lambda (x) (= elm x)) l))
+  (if (nil? l)
+      false
+      (if (= elm (car l))
+          true
+          (recur elm (cdr l)))))
 
 ;; Chars
 
@@ -1,9 +1,13 @@
-import random
-import re
-import string
+import hashlib
+import struct
+from contextlib import contextmanager
 
+from lang import conf
 from lang.debug import debug
 from lang.llvm import *
+from lang.nodes import (NIL, TRUE, FALSE, Char, Float, Int, Keyword, List,
+                        Str, Symbol, head)
+from lang.resolve import static_functions
 
 # Type mapping (for runtime values)
 RUNTIME_TYPES = {
@@ -23,12 +27,24 @@ RUNTIME_TYPES = {
     'keyword': 135,
 }
 
+# Values known to be ints, floats or bools are kept as native LLVM
+# values inside a function, so their LLVM type is their inferred type.
+# They are only boxed into runtime values when they escape, into an
+# untyped call, a global or a return. The runtime stores ints & floats
+# in 32 bits, so that is where boxing narrows them to.
+NATIVE_TYPES = {
+    T_I64: 'int',
+    T_F64: 'float',
+    T_BOOL: 'bool',
+}
+
 def store_value(env, value):
     """
     Compiles a set of instructions to store a value and returns an
-    anonymised pointer to it.
+    anonymised pointer to it. The stack slot is never released, see
+    Environment.temporary for values which are only needed briefly.
     """
-    ptr = env.builder.alloca(value.type)
+    ptr = env.stack_slot(value.type)
     env.builder.store(value, ptr)
     return env.builder.bitcast(ptr, T_VOID_PTR)
 
@@ -41,6 +57,41 @@ def make_string(value):
     value_type = ir.ArrayType(T_I8, len(byte_array))
     return ir.Constant(value_type, byte_array)
 
+def wrap_i32(n):
+    """Truncates n like a native i64 to i32 truncation."""
+    n &= (1 << 32) - 1
+    return n - (1 << 32) if n >= (1 << 31) else n
+
+def literal_key(expression):
+    """
+    Returns the bytes the runtime's value_hash hashes for a literal,
+    which also tell literals apart like the runtime's equality does,
+    or None if expression is not a literal.
+    """
+    if isinstance(expression, Int):
+        tag, data = 'int', struct.pack('<i', wrap_i32(expression.value))
+    elif isinstance(expression, Char):
+        tag, data = 'char', struct.pack('<i', expression.value)
+    elif isinstance(expression, Float):
+        tag, data = 'float', struct.pack('<f', expression.value)
+    elif isinstance(expression, (Str, Keyword)):
+        tag = 'string' if isinstance(expression, Str) else 'keyword'
+        data = expression.value.encode('utf8').split(b'\0')[0]
+    elif expression is NIL:
+        tag, data = 'nil', b''
+    elif expression is TRUE or expression is FALSE:
+        tag, data = 'bool', bytes([expression is TRUE])
+    else:
+        return None
+    return bytes([RUNTIME_TYPES[tag]]) + data
+
+def value_hash(key):
+    """64 bit FNV-1a, like the runtime's value_hash."""
+    h = 14695981039346656037
+    for byte in key:
+        h = ((h ^ byte) * 1099511628211) & ((1 << 64) - 1)
+    return h
+
 def fq_block_name(fn, block):
     return fn.name + '__' + block.name
 
@@ -53,14 +104,62 @@ class Environment:
         }
         self.global_scope = dict()
         self.scopes = [dict()]
+        self.lambda_count = 0
+        # (function name, type) -> released stack slots
+        self.free_slots = dict()
+        # (loop header block, argument phis) of the functions being
+        # compiled, innermost last, for recur to jump to.
+        self.loops = []
+        # Global name -> arity, for globals always holding a function.
+        self.static_functions = dict()
+        # id of a boxed lambda value -> LLVM function. By id, as LLVM
+        # values compare equal by name, which is only unique per
+        # function.
+        self.lambdas = dict()
+        # Names of functions to memoise -> their lookup table, see
+        # compile_memoised.
+        self.memo = dict()
+
+    def function(self, name, argc):
+        """
+        Returns the function called name, declaring it if it does not
+        exist yet.
+        """
+        func = self.lib.get(name)
+        if func is None:
+            f_type = ir.FunctionType(T_VALUE_STRUCT_PTR, [T_VALUE_STRUCT_PTR for _ in range(argc)])
+            func = ir.Function(self.builder.module, f_type, name=name)
+            self.lib[name] = func
+        return func
 
     def add_fn(self, name, argc):
-        f_type = ir.FunctionType(T_VALUE_STRUCT_PTR, [T_VALUE_STRUCT_PTR for _ in range(argc)])
-        func = ir.Function(self.builder.module, f_type, name=name)
-        self.lib[name] = func
+        """
+        Defines the function called name, which calls may have declared
+        already. A name defined more than once is never called
+        directly, so each definition gets a fresh function.
+        """
+        func = self.lib.get(name)
+        if func is not None and not func.is_declaration:
+            name = self.builder.module.get_unique_name(name)
+        elif func is not None and len(func.args) != argc:
+            raise Exception('{} is called with {} args, but defined with {}'
+                            .format(name, len(func.args), argc))
+        func = self.function(name, argc)
         entry = self.add_block('entry', fn=func)
         return func
 
+    def add_global(self, name):
+        """
+        Returns the global variable for name, creating it if it does not
+        exist yet.
+        """
+        gv = self.global_scope.get(name)
+        if gv is None:
+            gv = ir.GlobalVariable(self.builder.module, T_VALUE_STRUCT_PTR, name)
+            gv.linkage = 'internal'
+            self.global_scope[name] = gv
+        return gv
+
     def current_block_name(self):
         return fq_block_name(self.builder.function, self.builder.block)
 
@@ -79,6 +178,84 @@ class Environment:
             name=name
         )
 
+    def stack_slot(self, typ):
+        """
+        Returns a stack slot for typ in the entry block of the current
+        function, so it is allocated once per call, not per loop
+        iteration, and can be promoted. Reuses released slots.
+        """
+        fn = self.builder.function
+        free = self.free_slots.setdefault((fn.name, typ), [])
+        if free:
+            slot = free.pop()
+        else:
+            block = self.builder.block
+            self.builder.position_at_start(fn.entry_basic_block)
+            slot = self.builder.alloca(typ)
+            self.builder.position_at_end(block)
+        self.builder.call(self.lib['llvm.lifetime.start.p0i8'],
+                          [T_I64(-1), self.builder.bitcast(slot, T_VOID_PTR)])
+        return slot
+
+    def release_slot(self, slot):
+        """Ends the lifetime of a stack slot, so it can be reused."""
+        self.builder.call(self.lib['llvm.lifetime.end.p0i8'],
+                          [T_I64(-1), self.builder.bitcast(slot, T_VOID_PTR)])
+        fn = self.builder.function
+        self.free_slots[(fn.name, slot.type.pointee)].append(slot)
+
+    @contextmanager
+    def temporary(self, value):
+        """
+        Stores value in a stack slot for the duration of the block,
+        yielding an anonymised pointer to it.
+        """
+        slot = self.stack_slot(value.type)
+        self.builder.store(value, slot)
+        yield self.builder.bitcast(slot, T_VOID_PTR)
+        self.release_slot(slot)
+
+    def constant(self, name, typ, payload=None):
+        """
+        Returns a constant runtime value, emitted once per module. The
+        runtime never mutates values, so they can be shared. Payload is
+        a constant stored alongside it, or None for nil. Constants are
+        linkonce, so they are also shared between linked modules.
+        """
+        module = self.builder.module
+        name = 'const.' + name
+        try:
+            return module.get_global(name)
+        except KeyError:
+            pass
+        if payload is None:
+            vptr = NULL_PTR
+        else:
+            data = ir.GlobalVariable(module, payload.type, name + '.data')
+            data.initializer = payload
+            data.global_constant = True
+            data.linkage = 'linkonce_odr'
+            # The runtime reads this as a union Primitive.
+            data.align = 8
+            vptr = data.bitcast(T_VOID_PTR)
+        gv = ir.GlobalVariable(module, T_VALUE_STRUCT, name)
+        gv.initializer = T_VALUE_STRUCT([T_I32(RUNTIME_TYPES[typ]), vptr])
+        gv.global_constant = True
+        gv.linkage = 'linkonce_odr'
+        return gv
+
+    def constant_native(self, value):
+        """Returns the runtime value constant for a native constant."""
+        if T_BOOL == value.type:
+            return self.constant(
+                'true' if value.constant else 'false', 'bool', value)
+        if T_I64 == value.type:
+            n = wrap_i32(value.constant)
+            return self.constant('int.{}'.format(n), 'int', T_I32(n))
+        bits, = struct.unpack('<I', struct.pack('<f', value.constant))
+        return self.constant('float.{:08x}'.format(bits), 'float',
+                             ir.Constant(T_F32, value.constant))
+
     def unbox_value(self, val, out_type=T_I8, load=True):
         debug('out_type', out_type)
         val = self.builder.call(self.lib['unbox_value'], [val])
@@ -88,6 +265,148 @@ class Environment:
         val = self.builder.bitcast(val, out_type)
         return val
 
+    def box(self, value):
+        """
+        Returns value as a runtime value, boxing native values.
+        """
+        if T_VALUE_STRUCT_PTR == value.type:
+            return value
+        if T_NUMBER == value.type:
+            return self.box_number(value)
+        if isinstance(value, ir.Constant) and value.type in NATIVE_TYPES:
+            return self.constant_native(value)
+        if T_I64 == value.type:
+            # The runtime preboxes small ints.
+            return self.builder.call(self.lib['make_int'],
+                                     [self.builder.trunc(value, T_I32)])
+        if T_BOOL == value.type:
+            return self.builder.select(
+                value,
+                self.constant_native(T_BOOL(True)),
+                self.constant_native(T_BOOL(False)))
+        if T_F64 == value.type:
+            value = self.builder.fptrunc(value, T_F32)
+            tag = RUNTIME_TYPES['float']
+        else:
+            tag = FFI_TYPE_MAPPING[value.type]
+        if T_VOID_PTR == value.type:
+            return self.builder.call(self.lib['make_value'], [T_I32(tag), value])
+        if RUNTIME_TYPES['string'] <= tag:
+            # The runtime keeps pointers to anything but primitives, so
+            # the slot has to outlive the call.
+            return self.builder.call(self.lib['make_value'],
+                                     [T_I32(tag), store_value(self, value)])
+        # The runtime copies primitives, so the slot is only needed for
+        # the call.
+        with self.temporary(value) as vptr:
+            return self.builder.call(self.lib['make_value'], [T_I32(tag), vptr])
+
+    def box_number(self, value):
+        """Boxes a number as an int or a float, whichever it is."""
+        previous_block = self.builder.block
+        float_block = self.add_block('box_float')
+        as_float = self.box(self.builder.extract_value(value, 2))
+        float_end_block = self.builder.block
+        int_block = self.add_block('box_int')
+        as_int = self.box(self.builder.extract_value(value, 1))
+        int_end_block = self.builder.block
+        boxed_block = self.add_block('boxed')
+        with self.builder.goto_block(previous_block):
+            self.builder.cbranch(self.builder.extract_value(value, 0),
+                                 float_block, int_block)
+        for block in [float_end_block, int_end_block]:
+            with self.builder.goto_block(block):
+                self.builder.branch(boxed_block)
+        phi = self.builder.phi(T_VALUE_STRUCT_PTR)
+        phi.add_incoming(as_float, float_end_block)
+        phi.add_incoming(as_int, int_end_block)
+        return phi
+
+    def make_number(self, is_float, as_int, as_float):
+        number = ir.Constant(T_NUMBER, None)
+        for i, field in enumerate([is_float, as_int, as_float]):
+            number = self.builder.insert_value(number, field, i)
+        return number
+
+    def native(self, value, out_type):
+        """
+        Returns value as a native value of out_type, unboxing runtime
+        values. Runtime values of unknown type are assumed to be ints.
+        """
+        if out_type == value.type:
+            return value
+        if T_VALUE_STRUCT_PTR == out_type:
+            return self.box(value)
+        if T_NUMBER == value.type:
+            is_float = self.builder.extract_value(value, 0)
+            as_int = self.builder.extract_value(value, 1)
+            as_float = self.builder.extract_value(value, 2)
+            if T_F64 == out_type:
+                return self.builder.select(
+                    is_float, as_float, self.builder.sitofp(as_int, T_F64))
+            if isinstance(out_type, ir.IntType):
+                return self.native(self.builder.select(
+                    is_float, self.builder.fptosi(as_float, T_I64), as_int),
+                    out_type)
+            return self.native(self.box(value), out_type)
+        if T_VALUE_STRUCT_PTR == value.type:
+            if T_I64 == out_type:
+                return self.builder.sext(self.unbox_value(value, T_I32), T_I64)
+            if T_F64 == out_type:
+                # Ints are promoted, like native ones.
+                primitive = self.builder.call(self.lib['unbox_value'], [value])
+                as_float = self.builder.fpext(self.builder.load(
+                    self.builder.bitcast(primitive, T_F32.as_pointer())), T_F64)
+                as_int = self.builder.sitofp(self.builder.load(
+                    self.builder.bitcast(primitive, T_I32.as_pointer())), T_F64)
+                return self.builder.select(self.is_float(value),
+                                           as_float, as_int)
+            return self.unbox_value(
+                value,
+                out_type=out_type,
+                load=not hasattr(out_type, 'pointee')
+            )
+        if isinstance(value.type, ir.IntType) and isinstance(out_type, ir.IntType):
+            if value.type.width > out_type.width:
+                return self.builder.trunc(value, out_type)
+            if T_BOOL == value.type:
+                return self.builder.zext(value, out_type)
+            return self.builder.sext(value, out_type)
+        if isinstance(value.type, ir.IntType) and T_F64 == out_type:
+            return self.builder.sitofp(value, out_type)
+        if T_F64 == value.type and isinstance(out_type, ir.IntType):
+            return self.builder.fptosi(value, out_type)
+        # No direct conversion, so go through a runtime value.
+        return self.native(self.box(value), out_type)
+
+    def is_float(self, value):
+        """Returns an i1 for whether a runtime value or number is a float."""
+        if T_NUMBER == value.type:
+            return self.builder.extract_value(value, 0)
+        tag = self.builder.load(self.builder.gep(value, [T_I32(0), T_I32(0)]))
+        return self.builder.icmp_signed('==', tag,
+                                        T_I32(RUNTIME_TYPES['float']))
+
+    def truthy(self, value):
+        """
+        Returns an i1 for the truthiness of value, following the
+        runtime's value_truthy.
+        """
+        if T_BOOL == value.type:
+            return value
+        if T_I64 == value.type:
+            return self.builder.icmp_signed('>', value, T_I64(0))
+        if T_F64 == value.type:
+            return self.builder.fcmp_ordered('>', value, T_F64(0))
+        if T_NUMBER == value.type:
+            return self.builder.select(
+                self.builder.extract_value(value, 0),
+                self.truthy(self.builder.extract_value(value, 2)),
+                self.truthy(self.builder.extract_value(value, 1)))
+        if T_VALUE_STRUCT_PTR == value.type:
+            return self.builder.call(self.lib['value_truthy'], [value])
+        return T_BOOL(True)
+
     def call(self, name, args, tail=False):
         fn = self.lib[name]
         debug('fn.name', fn.name)
@@ -99,116 +418,208 @@ class Environment:
             raise Exception('Arity error: {} expected {} args, got {}'.format(
                 fn.name, len(fn.args), len(args)))
 
-        unboxed_args = []
-        for i in range(len(args)):
-            arg = args[i]
-            fn_arg = fn.args[i]
-            fn_arg_type = getattr(fn_arg, 'type', None)
-            if T_VALUE_STRUCT_PTR == arg.type and arg.type != fn_arg_type:
-                arg = self.unbox_value(
-                    arg,
-                    out_type=fn_arg_type,
-                    load=not hasattr(fn_arg_type, 'pointee')
-                )
-            unboxed_args.append(arg)
-        args = unboxed_args
+        args = [self.native(arg, fn_arg.type) for arg, fn_arg in zip(args, fn.args)]
 
         debug('args afterwards', [getattr(a, 'type', 'no type') for a in args])
         fn_retval = self.builder.call(fn, args, tail=tail)
-        if T_VALUE_STRUCT_PTR != fn.ftype.return_type:
-            debug('fn return type', fn.ftype.return_type)
-            # C FFI, we're not returning a boxed value, so box it.
-            if T_VOID == fn.ftype.return_type:
+        return_type = fn.ftype.return_type
+        if T_VALUE_STRUCT_PTR != return_type:
+            debug('fn return type', return_type)
+            # C FFI. Keep native return values native, they are boxed
+            # if & when they need to be.
+            if T_VOID == return_type:
                 # Synthesise a nil value for void functions.
                 fn_retval = compile_nil(self, None)
-            else:
-                if fn.ftype.return_type != T_VOID_PTR:
-                    fn_retval = store_value(self, fn_retval)
-                fn_retval = self.builder.call(
-                    self.lib['make_value'],
-                    [T_I32(FFI_TYPE_MAPPING[fn.ftype.return_type]), fn_retval]
-                )
+            elif return_type in [T_I32, T_I64]:
+                fn_retval = self.native(fn_retval, T_I64)
+            elif return_type not in [T_BOOL, T_VOID_PTR]:
+                fn_retval = self.box(fn_retval)
         return fn_retval
 
 
-def compile_if(env, expression, depth=0):
+def compile_if(env, expression, depth=0, tail=False):
     assert 4 == len(expression), 'if takes exactly 3 arguments'
     _, a, b, c = expression
-    condition = compile_expression(env, a, depth=depth+1)
-    if T_VALUE_STRUCT_PTR == condition.type:
-        condition = env.builder.call(env.lib['value_truthy'], [condition])
-
+    condition = env.truthy(compile_expression(env, a, depth=depth+1))
     previous_block = env.builder.block
-    endif_block = env.add_block('endif')
 
-    # Then
+    # The branches can end up in different blocks than they started
+    # in, so remember where they ended to jump to endif from there.
     then_block = env.add_block('then')
-    then_result = compile_expression(env, b, depth=depth+1)
-    # Add another else block so the PHI knows where the branch will
-    # come from, even if the inner expression changed blocks. Patch up
-    # the inner block to jump there.
-    then_inner_block = env.builder.block
-    then_end_block = env.add_block('then_end')
-    env.builder.branch(endif_block)
-    env.builder.position_at_end(then_inner_block)
-    env.builder.branch(then_end_block)
-
-    # Else
+    then_result = compile_expression(env, b, depth=depth+1, tail=tail)
+    then_end_block = env.builder.block
+
     else_block = env.add_block('else')
-    else_result = compile_expression(env, c, depth=depth+1)
-    # See above.
-    else_inner_block = env.builder.block
-    else_end_block = env.add_block('else_end')
-    env.builder.branch(endif_block)
-    env.builder.position_at_end(else_inner_block)
-    env.builder.branch(else_end_block)
+    else_result = compile_expression(env, c, depth=depth+1, tail=tail)
+    else_end_block = env.builder.block
 
     with env.builder.goto_block(previous_block):
         env.builder.cbranch(condition, then_block, else_block)
 
+    # Branches ending in recur have already jumped away.
+    branches = [(result, block) for result, block in
+                [(then_result, then_end_block), (else_result, else_end_block)]
+                if not block.is_terminated]
+    if not branches:
+        return None
+
+    # Branches of the same native type stay native, otherwise they
+    # meet as runtime values.
+    result_type = branches[0][0].type
+    if any(result.type != result_type for result, _ in branches):
+        result_type = T_VALUE_STRUCT_PTR
+
+    endif_block = env.add_block('endif')
+    incoming = []
+    for result, block in branches:
+        env.builder.position_at_end(block)
+        incoming.append((env.native(result, result_type), env.builder.block))
+        env.builder.branch(endif_block)
+
     env.builder.position_at_end(endif_block)
-    phi = env.builder.phi(T_VALUE_STRUCT_PTR)
-    phi.add_incoming(then_result, then_end_block)
-    phi.add_incoming(else_result, else_end_block)
+    phi = env.builder.phi(result_type)
+    for result, block in incoming:
+        phi.add_incoming(result, block)
     return phi
 
 def compile_native_op(env, expression, depth=0):
-    # TODO port this to C and operate on values instead.
     # XXX currently only 2-arity, use macros to reduce
-    assert 3 == len(expression), expression[0] + ' takes exactly 2 arguments'
+    assert 3 == len(expression), expression[0].name + ' takes exactly 2 arguments'
     a, b, c = expression
+    a = a.name
     lhs = compile_expression(env, b, depth=depth+1)
-    lhs = env.unbox_value(lhs, T_I32)
     rhs = compile_expression(env, c, depth=depth+1)
-    rhs = env.unbox_value(rhs, T_I32)
-    result = None
-    if '+' == a:
-        result = env.builder.add(lhs, rhs)
-    if '-' == a:
-        result = env.builder.sub(lhs, rhs)
-    if '*' == a:
-        result = env.builder.mul(lhs, rhs)
+    if T_F64 in [lhs.type, rhs.type]:
+        return compile_float_op(env, a, lhs, rhs)
+    dynamic = [value for value in [lhs, rhs]
+               if value.type in [T_VALUE_STRUCT_PTR, T_NUMBER]]
+    if not dynamic:
+        return compile_int_op(env, a, lhs, rhs)
+    # Runtime values can be ints or floats, which is only known at
+    # runtime, so compute both & pick, promoting to float if either
+    # operand is one.
+    is_float = env.is_float(dynamic[0])
+    for value in dynamic[1:]:
+        is_float = env.builder.or_(is_float, env.is_float(value))
+    as_float = compile_float_op(env, a, lhs, rhs)
     if '/' == a:
-        result = env.builder.sdiv(lhs, rhs)
+        # The int division must not trap on a float divisor.
+        rhs = env.builder.select(is_float, T_I64(1), env.native(rhs, T_I64))
+    as_int = compile_int_op(env, a, lhs, rhs)
+    if a in ['<', '<=', '==', '!=', '>=', '>']:
+        return env.builder.select(is_float, as_float, as_int)
+    return env.make_number(is_float, as_int, as_float)
+
+def compile_float_op(env, a, lhs, rhs):
+    lhs = env.native(lhs, T_F64)
+    rhs = env.native(rhs, T_F64)
     if a in ['<', '<=', '==', '!=', '>=', '>']:
-        result = env.builder.icmp_signed(a, lhs, rhs)
-        return env.call('make_value', [T_I32(RUNTIME_TYPES['bool']), store_value(env, result)])
-    return env.call('make_value', [T_I32(RUNTIME_TYPES['int']), store_value(env, result)])
+        return env.builder.fcmp_ordered(a, lhs, rhs)
+    return {
+        '+': env.builder.fadd,
+        '-': env.builder.fsub,
+        '*': env.builder.fmul,
+        '/': env.builder.fdiv,
+    }[a](lhs, rhs)
+
+def compile_int_op(env, a, lhs, rhs):
+    lhs = env.native(lhs, T_I64)
+    rhs = env.native(rhs, T_I64)
+    if a in ['<', '<=', '==', '!=', '>=', '>']:
+        return env.builder.icmp_signed(a, lhs, rhs)
+    return {
+        '+': env.builder.add,
+        '-': env.builder.sub,
+        '*': env.builder.mul,
+        '/': env.builder.sdiv,
+    }[a](lhs, rhs)
 
 def compile_box(env, expression, depth=0):
     assert 2 == len(expression), 'box takes exactly 1 argument'
-    return store_value(env, compile_expression(env, expression[1], depth=depth+1))
+    return store_value(env, env.box(compile_expression(env, expression[1], depth=depth+1)))
+
+def is_constant(value):
+    return isinstance(value, ir.GlobalVariable) and value.name.startswith('const.')
+
+def collection_type(item_type, count):
+    """The layout of the runtime's struct Vector & struct HashMap."""
+    return ir.LiteralStructType([T_I32, ir.ArrayType(item_type, count)])
 
-def compile_progn(env, expression, depth=0):
-    if [] == expression:
-        return env.call('make_value', [T_I32(RUNTIME_TYPES['nil']), NULL_PTR])
+def collection_digest(values):
+    names = ','.join(value.name for value in values)
+    return hashlib.sha1(names.encode('utf8')).hexdigest()[:16]
+
+def compile_vector(env, expression, depth=0):
+    """
+    Compiles a vector. If all items are constants, so is the vector,
+    otherwise it is allocated in one go & its items stored into it.
+    """
+    items = [env.box(compile_expression(env, item, depth=depth+1))
+             for item in expression[1:]]
+    typ = collection_type(T_VALUE_STRUCT_PTR, len(items))
+    if all(is_constant(item) for item in items):
+        payload = typ([T_I32(len(items)),
+                       ir.ArrayType(T_VALUE_STRUCT_PTR, len(items))(items)])
+        return env.constant('vector.' + collection_digest(items), 'vector',
+                            payload)
+    value = env.builder.call(env.lib['make_vector'], [T_I32(len(items))])
+    vector = env.unbox_value(value, typ.as_pointer(), load=False)
+    for i, item in enumerate(items):
+        env.builder.store(item, env.builder.gep(
+            vector, [T_I32(0), T_I32(1), T_I32(i)]))
+    return value
+
+def compile_hash_map(env, expression, depth=0):
+    """
+    Compiles a hash map. If all keys are literals & all values
+    constants, it is sorted & deduplicated here and is a constant,
+    otherwise it is allocated in one go, its entries stored into it
+    and the runtime sorts them.
+    """
+    if 0 == len(expression) % 2:
+        raise Exception('Hash maps take an even number of forms')
+    items = [env.box(compile_expression(env, item, depth=depth+1))
+             for item in expression[1:]]
+    pairs = list(zip(items[0::2], items[1::2]))
+    keys = [literal_key(key) for key in expression[1::2]]
+    typ = collection_type(T_ENTRY, len(pairs))
+    if None not in keys and all(is_constant(item) for item in items):
+        # The last of duplicate keys wins, in its place, like in the
+        # runtime's hash_map_index.
+        entries = dict()
+        for key, (k, v) in zip(keys, pairs):
+            entries.pop(key, None)
+            entries[key] = (value_hash(key), k, v)
+        entries = sorted(entries.values(), key=lambda entry: entry[0])
+        typ = collection_type(T_ENTRY, len(entries))
+        payload = typ([
+            T_I32(len(entries)),
+            ir.ArrayType(T_ENTRY, len(entries))(
+                [T_ENTRY([T_I64(h), k, v]) for h, k, v in entries]),
+        ])
+        return env.constant('hashmap.' + collection_digest(items), 'hashmap',
+                            payload)
+    value = env.builder.call(env.lib['make_hash_map'], [T_I32(len(pairs))])
+    hash_map = env.unbox_value(value, typ.as_pointer(), load=False)
+    for i, (k, v) in enumerate(pairs):
+        env.builder.store(k, env.builder.gep(
+            hash_map, [T_I32(0), T_I32(1), T_I32(i), T_I32(1)]))
+        env.builder.store(v, env.builder.gep(
+            hash_map, [T_I32(0), T_I32(1), T_I32(i), T_I32(2)]))
+    env.builder.call(env.lib['hash_map_index'], [value])
+    return value
+
+def compile_progn(env, expression, depth=0, tail=False):
+    if not expression:
+        return compile_nil(env, None)
     else:
         retval = None
-        for exp in expression:
-            retval = compile_expression(env, exp, depth=depth+1)
+        for i, exp in enumerate(expression, 1):
+            retval = compile_expression(env, exp, depth=depth+1,
+                                        tail=tail and len(expression) == i)
         return retval
 
-def compile_let(env, expression, depth=0):
+def compile_let(env, expression, depth=0, tail=False):
     assert 3 <= len(expression), 'let takes at least 2 arguments'
 
     bindings = expression[1]
@@ -216,125 +627,299 @@ def compile_let(env, expression, depth=0):
     for binding in bindings:
         assert 2 == len(binding), 'let bindings must be exactly 2 elements'
         k, v = binding
-        new_scope[k] = compile_expression(env, v, depth=depth+1)
+        new_scope[k.name] = compile_expression(env, v, depth=depth+1)
     env.scopes.append(new_scope)
 
     body = expression[2:]
-    retval = compile_progn(env, body, depth=depth+1)
+    retval = compile_progn(env, body, depth=depth+1, tail=tail)
     env.scopes.pop()
     return retval
 
-def compile_lambda(env, expression, name=None, depth=0):
+def compile_lambda_function(env, expression, name=None, depth=0):
+    """Compiles a lambda & returns the LLVM function."""
     assert 3 <= len(expression), 'lambda takes at least 3 arguments'
-    fn_name = name or '{}'.format(''.join(random.choice(string.ascii_lowercase)
-                                          for _ in range(6)))
-    fn_name = 'fn_' + fn_name
-    previous_block = env.current_block_name()
+    anonymous = name is None
+    if anonymous:
+        # Anonymous functions are numbered, so output is deterministic,
+        # with brackets, which symbols can't contain, so they never
+        # clash with a defun.
+        name = 'lambda[{}]'.format(env.lambda_count)
+        env.lambda_count += 1
+    fn_name = 'fn_' + name
+    previous_block = env.builder.block
     args = expression[1]
     fn = env.add_fn(fn_name, len(args))
+    if name not in env.static_functions:
+        # Only reached through its boxed value, so it is internal, and
+        # units can be linked without clashes.
+        fn.linkage = 'internal'
+
+    # recur jumps back to the loop header, rebinding the arguments.
+    entry_block = env.builder.block
+    loop_block = env.add_block('loop')
+    with env.builder.goto_block(entry_block):
+        env.builder.branch(loop_block)
+    phis = []
+    for arg in fn.args:
+        phi = env.builder.phi(T_VALUE_STRUCT_PTR)
+        phi.add_incoming(arg, entry_block)
+        phis.append(phi)
 
     body = (expression[2:])
-    fn_args = fn.args
-    new_scope = dict(zip ([arg for arg in args], fn.args))
+    new_scope = dict(zip ([arg.name for arg in args], phis))
     env.scopes.append(new_scope)
-    retval = compile_progn(env, body, depth=depth+1)
-    env.builder.ret(retval)
+    env.loops.append((loop_block, phis))
+    retval = compile_progn(env, body, depth=depth+1, tail=True)
+    if not env.builder.block.is_terminated:
+        env.builder.ret(env.box(retval))
+    env.loops.pop()
     env.scopes.pop()
 
-    env.builder.position_at_end(env.blocks[previous_block])
+    env.builder.position_at_end(previous_block)
+    return fn
+
+def compile_memoised(env, expression, name, depth=0):
+    """
+    Compiles a pure function behind a memo table, a direct-mapped
+    cache of its results by int arguments, where newer results evict
+    older ones. A lookup table of results precomputed for 0 and up,
+    if any, is checked first. Calls with other arguments go straight
+    to the function. Returns the function.
+    """
+    impl = compile_lambda_function(env, expression, name=name + '.impl',
+                                   depth=depth)
+    impl.linkage = 'internal'
+    module = env.builder.module
+    argc = len(impl.args)
+
+    def memo_global(kind, typ, initializer=None):
+        gv = ir.GlobalVariable(module, typ, 'memo.{}.{}'.format(name, kind))
+        gv.initializer = initializer or ir.Constant(typ, None)
+        gv.linkage = 'internal'
+        return gv
+
+    def count(counter):
+        env.builder.store(env.builder.add(env.builder.load(counter), T_I64(1)),
+                          counter)
+
+    hits = memo_global('hits', T_I64)
+    misses = memo_global('misses', T_I64)
+    keys = memo_global('keys', ir.ArrayType(ir.ArrayType(T_I32, argc),
+                                            conf.MEMO_SIZE))
+    results = memo_global('results', ir.ArrayType(T_VALUE_STRUCT_PTR,
+                                                  conf.MEMO_SIZE))
+    table = env.memo.get(name)
+
+    previous_block = env.builder.block
+    fn = env.add_fn('fn_' + name, argc)
+    builder = env.builder
+    cacheable = T_BOOL(True)
+    for arg in fn.args:
+        tag = builder.load(builder.gep(arg, [T_I32(0), T_I32(0)]))
+        cacheable = builder.and_(cacheable, builder.icmp_unsigned(
+            '==', tag, T_I32(RUNTIME_TYPES['int'])))
+    lookup_block = env.add_block('lookup')
+    cache_block = env.add_block('cache')
+    hit_block = env.add_block('hit')
+    miss_block = env.add_block('miss')
+    uncached_block = env.add_block('uncached')
+    with builder.goto_entry_block():
+        builder.cbranch(cacheable, lookup_block, uncached_block)
+
+    builder.position_at_end(lookup_block)
+    ints = [env.unbox_value(arg, T_I32) for arg in fn.args]
+    if table:
+        values = [env.box(compile_expression(env, literal)) for literal in table]
+        table = memo_global('table', ir.ArrayType(T_VALUE_STRUCT_PTR, len(table)),
+                            ir.Constant.literal_array(values))
+        table.global_constant = True
+        in_table = builder.icmp_unsigned('<', ints[0], T_I32(len(values)))
+        with builder.if_then(in_table):
+            result = builder.load(builder.gep(
+                table, [T_I32(0), builder.zext(ints[0], T_I64)]))
+            builder.branch(hit_block)
+            table_block = builder.block
+    builder.branch(cache_block)
+
+    # Fibonacci hashing, so runs of ints spread over the table.
+    builder.position_at_end(cache_block)
+    h = ints[0]
+    for n in ints[1:]:
+        h = builder.add(builder.mul(h, T_I32(31)), n)
+    bits = conf.MEMO_SIZE.bit_length() - 1
+    index = builder.zext(builder.lshr(builder.mul(h, T_I32(0x9E3779B1)),
+                                      T_I32(32 - bits)), T_I64)
+    key_ptrs = [builder.gep(keys, [T_I32(0), index, T_I32(i)])
+                for i in range(argc)]
+    result_ptr = builder.gep(results, [T_I32(0), index])
+    cached = builder.load(result_ptr)
+    found = builder.icmp_unsigned('!=', cached,
+                                  ir.Constant(T_VALUE_STRUCT_PTR, None))
+    for key_ptr, n in zip(key_ptrs, ints):
+        found = builder.and_(found, builder.icmp_signed(
+            '==', builder.load(key_ptr), n))
+    builder.cbranch(found, hit_block, miss_block)
+
+    builder.position_at_end(hit_block)
+    phi = builder.phi(T_VALUE_STRUCT_PTR)
+    phi.add_incoming(cached, cache_block)
+    if table:
+        phi.add_incoming(result, table_block)
+    count(hits)
+    builder.ret(phi)
+
+    builder.position_at_end(miss_block)
+    count(misses)
+    result = builder.call(impl, fn.args)
+    for key_ptr, n in zip(key_ptrs, ints):
+        builder.store(n, key_ptr)
+    builder.store(result, result_ptr)
+    builder.ret(result)
+
+    builder.position_at_end(uncached_block)
+    count(misses)
+    builder.ret(builder.call(impl, fn.args))
+
+    # Register the counters with the runtime where the function is
+    # defined, see NEBULA_MEMO_STATS.
+    builder.position_at_end(previous_block)
+    label = ir.GlobalVariable(module, make_string(name).type,
+                              'memo.{}.name'.format(name))
+    label.initializer = make_string(name)
+    label.global_constant = True
+    label.linkage = 'internal'
+    env.call('memo_register', [label.bitcast(T_VOID_PTR), hits, misses])
+    return fn
+
+def compile_lambda(env, expression, name=None, depth=0):
+    if name in env.memo:
+        fn = compile_memoised(env, expression, name, depth=depth)
+    else:
+        fn = compile_lambda_function(env, expression, name=name, depth=depth)
     fn_ptr = env.builder.bitcast(fn, T_VOID_PTR)
-    fn_value = env.call(
-        'make_function', [store_value(env, make_string(fn_name)), fn_ptr]
-    )
+    # The runtime copies the name.
+    with env.temporary(make_string(fn.name)) as name_ptr:
+        fn_value = env.call('make_function', [name_ptr, fn_ptr])
+    env.lambdas[id(fn_value)] = fn
     return fn_value
 
 def compile_defun(env, expression, depth=0):
     assert 4 <= len(expression), 'defun takes at least 3 arguments'
-    fn_name = expression.pop(1)
-    gv = ir.GlobalVariable(env.builder.module, T_VALUE_STRUCT_PTR, fn_name)
-    gv.linkage = 'internal'
-    env.global_scope[fn_name] = gv
-    fn = compile_lambda(env, expression, name=fn_name, depth=depth+1)
+    fn_name = expression[1].name
+    gv = env.add_global(fn_name)
+    fn = compile_lambda(env, List(expression[:1] + expression[2:]),
+                        name=fn_name, depth=depth+1)
     env.builder.store(fn , gv)
     return fn
 
 def compile_def(env, expression, depth=0):
     assert 3 == len(expression), 'def takes exactly two arguments'
     _, name, val = expression
-    evaled_value = compile_expression(env, val, depth=depth+1)
+    evaled_value = env.box(compile_expression(env, val, depth=depth+1))
     debug('evaled_value', evaled_value)
-    gv = ir.GlobalVariable(env.builder.module, T_VALUE_STRUCT_PTR, name)
     # It can't be constant because we have to write to it, as we don't
     # know the value at compile-time.
-    # gv.global_constant = True
-    # gv.initializer = evaled_value
-    gv.linkage = 'internal'
+    gv = env.add_global(name.name)
     env.builder.store(evaled_value , gv)
-    env.global_scope[name] = gv
     debug('gv', gv)
-    return gv
+    return evaled_value
 
-def compile_recur(env, expression, depth=0):
-    args = [compile_expression(env, arg) for arg in expression[1:]]
-    current_fn_name = env.builder.function.name
-    return env.call(current_fn_name, args, tail=True)
+def compile_recur(env, expression, depth=0, tail=False):
+    """
+    Compiles recur into a jump back to the start of the current
+    function, so it runs in constant stack. Returns None, as control
+    never comes back.
+    """
+    if not env.loops:
+        raise Exception('recur outside of a function')
+    if not tail:
+        raise Exception('recur must be in tail position')
+    loop_block, phis = env.loops[-1]
+    args = [env.box(compile_expression(env, arg, depth=depth+1))
+            for arg in expression[1:]]
+    if len(args) != len(phis):
+        raise Exception('Arity error: {} expected {} args, got {}'.format(
+            env.builder.function.name, len(phis), len(args)))
+    for phi, arg in zip(phis, args):
+        phi.add_incoming(arg, env.builder.block)
+    env.builder.branch(loop_block)
 
 def compile_declare(env, expression, depth=0):
     _, name, return_type, arg_types = expression
     env.declare_fn(
-        name,
-        FFI_TYPES[return_type],
-        [FFI_TYPES[t] for t in arg_types]
+        name.name,
+        FFI_TYPES[return_type.name],
+        [FFI_TYPES[t.name] for t in arg_types]
     )
 
-def compile_function_call(env, expression, depth=0):
-    if 'declare' == expression[0]:
-        return compile_declare(env, expression, depth=depth+1)
-
-    if 'lambda' == expression[0]:
-        return compile_lambda(env, expression, depth=depth+1)
-
-    if 'recur' == expression[0]:
-        return compile_recur(env, expression, depth=depth+1)
-
-    if 'def' == expression[0]:
-        return compile_def(env, expression, depth=depth+1)
-
-    if 'defun' == expression[0]:
-        return compile_defun(env, expression, depth=depth+1)
-
-    if 'progn' == expression[0]:
-        return compile_progn(env, expression[1:], depth=depth+1)
-
-    if 'let' == expression[0]:
-        return compile_let(env, expression, depth=depth+1)
-
-    if 'box' == expression[0]:
-        return compile_box(env, expression, depth=depth+1)
-
-    if 'if' == expression[0]:
-        return compile_if(env, expression, depth=depth+1)
-
-    if expression[0] in ['+', '-', '*', '/',
-                         '<', '<=', '==', '!=', '>=', '>']:
-        return compile_native_op(env, expression, depth=depth+1)
+def resolve_function(env, name):
+    """
+    Returns the LLVM function a call to name is known to reach, or
+    None if it has to be looked up at runtime.
+    """
+    for scope in reversed(env.scopes):
+        if name in scope:
+            # Let bindings are never rebound, only shadowed.
+            return env.lambdas.get(id(scope[name]))
+    if name in env.static_functions:
+        return env.function('fn_' + name, env.static_functions[name])
+    return None
+
+def compile_progn_form(env, expression, depth=0, tail=False):
+    return compile_progn(env, expression[1:], depth=depth, tail=tail)
+
+# Special forms by name, and those of them which pass on tail position.
+SPECIAL_FORMS = {
+    'declare': compile_declare,
+    'lambda': compile_lambda,
+    'recur': compile_recur,
+    'def': compile_def,
+    'defun': compile_defun,
+    'progn': compile_progn_form,
+    'let': compile_let,
+    'box': compile_box,
+    'if': compile_if,
+    '[]': compile_vector,
+    '{}': compile_hash_map,
+}
+TAIL_FORMS = {'recur', 'progn', 'let', 'if'}
+NATIVE_OPS = {'+', '-', '*', '/', '<', '<=', '==', '!=', '>=', '>'}
+
+def compile_function_call(env, expression, depth=0, tail=False):
+    callee = expression[0]
+    if isinstance(callee, Symbol):
+        if callee.name in SPECIAL_FORMS:
+            compile_form = SPECIAL_FORMS[callee.name]
+            if callee.name in TAIL_FORMS:
+                return compile_form(env, expression, depth=depth+1, tail=tail)
+            return compile_form(env, expression, depth=depth+1)
+        if callee.name in NATIVE_OPS:
+            return compile_native_op(env, expression, depth=depth+1)
 
     # else: function call
     args = []
     for exp in expression[1:]:
         args += [compile_expression(env, exp, depth=depth+1)]
 
-    if isinstance(expression[0], list):
+    if 'lambda' == head(callee):
+        # Immediately applied, so there is no need to box it.
+        fn = compile_lambda_function(env, callee, depth=depth+1)
+        return env.call(fn.name, args)
+    elif isinstance(callee, List):
         # Function is a function call? Eval it.
-        fn_value = compile_expression(env, expression[0])
-    elif expression[0] in env.lib:
+        fn_value = compile_expression(env, callee)
+    elif not isinstance(callee, Symbol):
+        raise Exception("Can't call a literal: {}".format(callee))
+    elif callee.name in env.lib:
         # If it's a global function just jump there.
-        return env.call(expression[0], args)
-    elif compile_symbol(env, expression[0]):
-        # Try looking it up in the local scope first.
-        fn_value = compile_symbol(env, expression[0])
+        return env.call(callee.name, args)
+    elif resolve_function(env, callee.name) is not None:
+        # Known at compile time, so skip the function value.
+        fn = resolve_function(env, callee.name)
+        return env.call(fn.name, args)
     else:
-        raise Exception("Couldn't find function: " + expression[0])
+        # Try looking it up in the local scope first.
+        fn_value = compile_symbol(env, callee)
 
     # There is a lot of pointer following and struct indexing going on
     # here until we finally get to the function pointer.
@@ -346,6 +931,7 @@ def compile_function_call(env, expression, depth=0):
     fn_ptr_ptr = env.builder.gep(fn_struct_ptr, [T_I32(0), T_I32(1)])
 
     fn_ptr = env.builder.load(fn_ptr_ptr)
+    args = [env.box(arg) for arg in args]
     fn_ptr_type = ir.FunctionType(
         T_VALUE_STRUCT_PTR,
         [T_VALUE_STRUCT_PTR for _ in range(len(args))]
@@ -354,133 +940,100 @@ def compile_function_call(env, expression, depth=0):
     return env.builder.call(fn_ptr, args)
 
 def compile_constant_string(env, expression):
-    # Strip quotation marks
-    # Convert escape sequences
-    # XXX eval is the hacky way of accomplishing this.
-    # It's fine because we can trust our input.
-    val = make_string(eval(expression))
-    vptr = store_value(env, val)
-    typ = ir.Constant(T_I32, RUNTIME_TYPES['string'])
-    runtime_value = env.builder.call(env.lib['make_value'], [typ, vptr])
-    return runtime_value
+    val = make_string(expression.value)
+    digest = hashlib.sha1(val.constant).hexdigest()[:16]
+    return env.constant('string.' + digest, 'string', val)
 
 def compile_constant_int(env, expression):
-    val = ir.Constant(T_I32, int(expression))
-    vptr = store_value(env, val)
-    typ = ir.Constant(T_I32, RUNTIME_TYPES['int'])
-    runtime_value = env.builder.call(env.lib['make_value'], [typ, vptr])
-    return runtime_value
+    return ir.Constant(T_I64, expression.value)
 
 def compile_constant_float(env, expression):
-    # XXX Smaller floats aren't passed correctly to printf, resulting
-    # in misread values. This has to do with us not having explicit
-    # type casts, and not knowing what to cast to for variadic
-    # function arguments.
-    val = ir.Constant(T_F32, float(expression))
-    vptr = store_value(env, val)
-    typ = ir.Constant(T_I32, RUNTIME_TYPES['float'])
-    runtime_value = env.call('make_value', [typ, vptr])
-    return runtime_value
+    return ir.Constant(T_F64, expression.value)
 
 def compile_constant_bool(env, expression):
-    val = ir.Constant(T_BOOL, 'true' == expression)
-    vptr = store_value(env, val)
-    typ = ir.Constant(T_I32, RUNTIME_TYPES['bool'])
-    runtime_value = env.builder.call(env.lib['make_value'], [typ, vptr])
-    return runtime_value
+    return ir.Constant(T_BOOL, expression is TRUE)
 
 def compile_nil(env, expression):
-    vptr = NULL_PTR
-    typ = ir.Constant(T_I32, RUNTIME_TYPES['nil'])
-    runtime_value = env.builder.call(env.lib['make_value'], [typ, vptr])
-    return runtime_value
+    return env.constant('nil', 'nil')
 
 def compile_keyword(env, expression):
     # Basically just a string with a different type.
-    val = make_string(expression[1:])
-    vptr = store_value(env, val)
-    typ = ir.Constant(T_I32, RUNTIME_TYPES['keyword'])
-    runtime_value = env.builder.call(env.lib['make_value'], [typ, vptr])
-    return runtime_value
+    val = make_string(expression.value)
+    return env.constant('keyword.' + expression.value, 'keyword', val)
 
 def compile_constant_char(env, expression):
     # Chars are encoded as integers.
-    if 2 == len(expression):
-        val = ir.Constant(T_I32, ord(expression[1]))
-    else:
-        char_mapping = {
-            'newline': '\n',
-            'space': ' ',
-            'tab': '\t',
-            '(': '(',
-            ')': ')',
-            '"': '"',
-        }
-        val = ir.Constant(T_I32, ord(char_mapping[expression[1:]]))
-    vptr = store_value(env, val)
-    typ = ir.Constant(T_I32, RUNTIME_TYPES['char'])
-    runtime_value = env.builder.call(env.lib['make_value'], [typ, vptr])
-    return runtime_value
+    return env.constant('char.{}'.format(expression.value), 'char',
+                        T_I32(expression.value))
 
 def compile_symbol(env, expression):
-    debug('trying to resolve', expression)
-    for scope in reversed(env.scopes):
-        debug('searching scope:', scope.keys())
-        if expression in scope:
-            return scope[expression]
-    debug('Could not find symbol ' + expression + ' in local scope')
-    if expression in env.global_scope:
-        debug('Found symbol ' + expression + ' in global scope:')
-        debug(env.global_scope[expression])
-        return env.builder.load(env.global_scope[expression])
-    raise Exception('Could not find symbol ' + expression + ' in global scope')
-
-def compile_expression(env, expression, depth=0):
-    debug(' ' * (depth + 1) + 'Compiling expression: ' + str(expression))
-
-    if isinstance(expression, list):
-        # function call
-        return compile_function_call(env, expression, depth)
-    elif 'nil' == expression:
+    if expression is NIL:
         return compile_nil(env, expression)
-    elif expression in ['true', 'false']:
+    if expression is TRUE or expression is FALSE:
         return compile_constant_bool(env, expression)
-    elif '"' == expression[0]:
-        # constant string
-        return compile_constant_string(env, expression)
-    elif re.match('^\\\\(\w|space|newline|tab|\(|\)|"|;|\\\\)$', expression):
-        # char (NOTE: this regex above matches "\c")
-        return compile_constant_char(env, expression)
-    elif re.match('^-?[0-9]+\.[0-9]+$', expression):
-        # constant float
-        return compile_constant_float(env, expression)
-    elif re.match('^-?[0-9]+$', expression):
-        # constant int
-        return compile_constant_int(env, expression)
-    elif re.match('^:[a-zA-Z_-]+$', expression):
-        # keyword
-        return compile_keyword(env, expression)
-    else:
-        # symbol
-        return compile_symbol(env, expression)
+    name = expression.name
+    debug('trying to resolve', name)
+    for scope in reversed(env.scopes):
+        debug('searching scope:', scope.keys())
+        if name in scope:
+            return scope[name]
+    debug('Could not find symbol ' + name + ' in local scope')
+    if name in env.global_scope:
+        debug('Found symbol ' + name + ' in global scope:')
+        debug(env.global_scope[name])
+        return env.builder.load(env.global_scope[name])
+    raise Exception('Could not find symbol ' + name + ' in global scope')
+
+# Atoms are classified by the parser, so they dispatch on node type.
+ATOMS = {
+    Symbol: compile_symbol,
+    Int: compile_constant_int,
+    Float: compile_constant_float,
+    Str: compile_constant_string,
+    Char: compile_constant_char,
+    Keyword: compile_keyword,
+}
 
-def compile_main(ast):
-    module = ir.Module(name='main')
-    module.triple = llvm.get_default_triple()
+def compile_expression(env, expression, depth=0, tail=False):
+    debug(' ' * (depth + 1) + 'Compiling expression:', expression)
 
-    # LLVM main function
-    f_type = ir.FunctionType(T_I32, [T_I32, T_VOID_PTR.as_pointer()])
-    main_fn = ir.Function(module, f_type, name='main')
-    main_entry_block = main_fn.append_basic_block('entry')
-    env = Environment(module, main_entry_block)
+    if isinstance(expression, List):
+        # function call
+        return compile_function_call(env, expression, depth, tail=tail)
+    return ATOMS[type(expression)](env, expression)
 
-    # Declare libnebula. These are used in the compiler and have to be
-    # declared before usercode starts.
+def compile_runtime_declarations(env):
+    """
+    Declare libnebula. These are used in the compiler and have to be
+    declared before usercode starts.
+    """
     env.declare_fn("nebula_main", T_I32, [T_I32, T_VOID_PTR.as_pointer()])
     env.declare_fn('make_value', T_VALUE_STRUCT_PTR, [T_I32, T_VOID_PTR])
+    env.declare_fn('make_int', T_VALUE_STRUCT_PTR, [T_I32])
     env.declare_fn('unbox_value', T_PRIMITIVE_PTR, [T_VALUE_STRUCT_PTR])
     env.declare_fn('make_function', T_VALUE_STRUCT_PTR, [T_VOID_PTR, T_VOID_PTR])
     env.declare_fn('cons', T_VALUE_STRUCT_PTR, [T_VALUE_STRUCT_PTR, T_VALUE_STRUCT_PTR])
+    env.declare_fn('make_vector', T_VALUE_STRUCT_PTR, [T_I32])
+    env.declare_fn('make_hash_map', T_VALUE_STRUCT_PTR, [T_I32])
+    env.declare_fn('hash_map_index', T_VOID, [T_VALUE_STRUCT_PTR])
+    env.declare_fn('memo_register', T_VOID, [T_VOID_PTR, T_I64.as_pointer(),
+                                             T_I64.as_pointer()])
+    env.declare_fn('llvm.lifetime.start.p0i8', T_VOID, [T_I64, T_VOID_PTR])
+    env.declare_fn('llvm.lifetime.end.p0i8', T_VOID, [T_I64, T_VOID_PTR])
+
+def compile_entry_points(module):
+    """
+    Compiles the LLVM main function, which dispatches to the runtime,
+    and the implicit user code main function the runtime calls back
+    into. Returns the environment, positioned in user code main, and
+    the argv cons.
+    """
+    # LLVM main function
+    f_type = ir.FunctionType(T_I32, [T_I32, T_VOID_PTR.as_pointer()])
+    main_fn = ir.Function(module, f_type, name='main')
+    main_entry_block = main_fn.append_basic_block('entry')
+    env = Environment(module, main_entry_block)
+    compile_runtime_declarations(env)
 
     # Dispatch to runtime main function
     argc, argv = main_fn.args
@@ -501,7 +1054,7 @@ def compile_main(ast):
     env.builder.position_at_end(usercode_main_entry_block)
     ctr_ptr = env.builder.alloca(argc.type)
     env.builder.store(argc, ctr_ptr)
-    cons = env.call('make_value', [T_I32(RUNTIME_TYPES['nil']), NULL_PTR])
+    cons = compile_nil(env, None)
     cons_ptr = env.builder.alloca(cons.type)
     env.builder.store(cons, cons_ptr)
     env.builder.branch(loop_block)
@@ -510,10 +1063,7 @@ def compile_main(ast):
     env.builder.position_at_end(loop_block)
     current_ctr = env.builder.load(ctr_ptr)
     new_ctr = env.builder.sub(current_ctr, T_I32(1))
-    new_ctr_value = env.call(
-        'make_value',
-        [T_I32(RUNTIME_TYPES['int']), store_value(env, new_ctr)]
-    )
+    new_ctr_value = env.call('make_int', [new_ctr])
     this_argv = env.builder.gep(argv, [new_ctr])
     this_argv = env.builder.load(this_argv)
     this_argv_value = env.call('make_value', [T_I32(RUNTIME_TYPES['string']), this_argv])
@@ -533,7 +1083,19 @@ def compile_main(ast):
     #         store_value(env, make_string('\n'))
     #     ])
     # ])
-    env.scopes[0]['argv'] = env.builder.load(cons_ptr)
+    return env, env.builder.load(cons_ptr)
+
+def compile_main(ast, memo=None):
+    """
+    Compiles a whole program. memo maps the names of functions to
+    memoise to their lookup tables, see lang.memo.
+    """
+    module = ir.Module(name='main')
+    module.triple = llvm.get_default_triple()
+    env, argv = compile_entry_points(module)
+    env.scopes[0]['argv'] = argv
+    env.static_functions = static_functions(ast)
+    env.memo = memo or dict()
 
     # Compile user code
     for expression in ast:
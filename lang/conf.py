@@ -1,3 +1,17 @@
 DEBUG = False
-OPTIMISE = False
+# Optimisation level, one of '0'-'3', 's' or 'z', like the -O flags.
+OPTIMISE = '0'
 
+# Unix socket of the compile server, relative to the temp directory.
+SERVER_SOCKET = 'lang-server.sock'
+# Steps, i.e. function calls & recurs, compile-time evaluation of a
+# call to a pure function may take, and seconds evaluation may take
+# per build. A timeout of 0 disables it.
+EVALUATE_STEPS = 1000000
+EVALUATE_TIMEOUT = 2.0
+# Entries in the memo table of a memoised function, a power of two,
+# and the most results of one precomputed into its lookup table.
+MEMO_SIZE = 4096
+MEMO_TABLE_SIZE = 256
+# Top-level forms per unit when streaming, see lang.units.compile_stream.
+STREAM_FORMS = 64
@@ -1,5 +1,69 @@
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
 from lang.conf import DEBUG
 
 def debug(*args):
     if DEBUG:
         print(*args)
+
+class PhaseTimer:
+    """
+    Collects wall time, CPU time and peak Python memory per compiler
+    phase, as well as arbitrary counters. Does nothing unless enabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.phases = []
+        self.counts = dict()
+
+    def enable(self):
+        self.enabled = True
+        tracemalloc.start()
+
+    def reset(self):
+        """Disables the timer and forgets everything it collected."""
+        if self.enabled:
+            tracemalloc.stop()
+        self.__init__()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        # Clearing the traces also resets the peak, so each phase only
+        # sees its own allocations.
+        tracemalloc.clear_traces()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            _, peak = tracemalloc.get_traced_memory()
+            self.phases.append((name, wall, cpu, peak))
+
+    def count(self, name, n):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def report(self, fp=sys.stderr):
+        if not self.enabled:
+            return
+        print('{:<20} {:>10} {:>10} {:>12}'.format(
+            'phase', 'wall (ms)', 'cpu (ms)', 'peak (KiB)'), file=fp)
+        for name, wall, cpu, peak in self.phases:
+            print('{:<20} {:>10.2f} {:>10.2f} {:>12.1f}'.format(
+                name, wall * 1000, cpu * 1000, peak / 1024), file=fp)
+        print('{:<20} {:>10.2f} {:>10.2f}'.format(
+            'total',
+            sum(p[1] for p in self.phases) * 1000,
+            sum(p[2] for p in self.phases) * 1000), file=fp)
+        for name, n in self.counts.items():
+            print('{:<20} {:>10}'.format(name, n), file=fp)
+
+timer = PhaseTimer()
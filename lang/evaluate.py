@@ -0,0 +1,368 @@
+"""
+Compile-time evaluation.
+
+Calls to pure functions (see lang.resolve.pure_functions) with only
+literal arguments are compiled into a module of their own, together
+with the pure functions, and run through the JIT. Calls are replaced
+by their results, if those are literals, and the AST simplified again,
+which can make more calls foldable.
+
+Every call gets a budget of steps, one per function call or recur,
+so runaway recursion or loops trap instead of hanging the build. The
+JIT runs in a forked child process, so a call which crashes or traps
+only ends the child, and whole evaluation has a time budget on top.
+Such calls are left to run at runtime.
+"""
+import ctypes
+import faulthandler
+import json
+import os
+import select
+import signal
+import time
+
+from lang import conf
+from lang.compiler import (RUNTIME_TYPES, Environment, compile_expression,
+                           compile_lambda_function,
+                           compile_runtime_declarations)
+from lang.debug import debug
+from lang.llvm import *
+from lang.nodes import (NIL, TRUE, FALSE, Char, Float, Int, Keyword, List,
+                        Literal, Str, head)
+from lang.resolve import pure_functions
+from lang.simplify import names, rebuild, simplify
+from lang.units import symbols
+
+def is_literal(form):
+    return isinstance(form, Literal) or form in [NIL, TRUE, FALSE]
+
+def map_calls(form, arity, f, bound=frozenset()):
+    """
+    Replaces every call to one of the functions in arity, a dict of
+    name to arity, with only literal arguments, by f(call). Innermost
+    calls first, and respecting shadowing.
+    """
+    if not isinstance(form, List) or not form:
+        return form
+    name = head(form)
+    if 'declare' == name:
+        return form
+    if name in ['lambda', 'defun']:
+        params = 1 if 'lambda' == name else 2
+        if len(form) <= params or not isinstance(form[params], List):
+            return form
+        inner = bound | set(names(form[params]))
+        return rebuild(form, form.items[:params + 1] + tuple(
+            map_calls(f_, arity, f, inner) for f_ in form[params + 1:]))
+    if ('let' == name and 2 <= len(form) and isinstance(form[1], List)
+            and all(isinstance(b, List) and 2 == len(b) for b in form[1])):
+        # Binding values are evaluated in the outer scope.
+        bindings = rebuild(form[1], [
+            rebuild(b, [b[0], map_calls(b[1], arity, f, bound)])
+            for b in form[1]])
+        inner = bound | set(names(b[0] for b in form[1]))
+        return rebuild(form, (form[0], bindings) + tuple(
+            map_calls(f_, arity, f, inner) for f_ in form[2:]))
+    form = rebuild(form, [map_calls(f_, arity, f, bound) for f_ in form.items])
+    if (name in arity and name not in bound
+            and arity[name] == len(form) - 1
+            and all(is_literal(arg) for arg in form[1:])):
+        return f(form)
+    return form
+
+def compile_eval_runtime(env):
+    """
+    Defines the few runtime functions pure code calls, as the runtime
+    itself is not loaded into the compiler. They follow nebula.c, but
+    only need to handle the values pure code can produce.
+    """
+    module = env.builder.module
+    malloc = ir.Function(module, ir.FunctionType(T_VOID_PTR, [T_I64]),
+                         name='malloc')
+
+    fn = env.lib['unbox_value']
+    builder = ir.IRBuilder(fn.append_basic_block('entry'))
+    value, = fn.args
+    ptr = builder.load(builder.gep(value, [T_I32(0), T_I32(1)]))
+    builder.ret(builder.bitcast(ptr, T_PRIMITIVE_PTR))
+
+    fn = env.lib['make_value']
+    tag, ptr = fn.args
+    entry = fn.append_basic_block('entry')
+    copy = fn.append_basic_block('copy')
+    done = fn.append_basic_block('done')
+    builder = ir.IRBuilder(entry)
+    value = builder.bitcast(builder.call(malloc, [T_I64(16)]),
+                            T_VALUE_STRUCT_PTR)
+    builder.store(tag, builder.gep(value, [T_I32(0), T_I32(0)]))
+    # Primitives are copied, everything else is a constant here.
+    builder.cbranch(builder.and_(
+        builder.icmp_unsigned('!=', tag, T_I32(RUNTIME_TYPES['nil'])),
+        builder.icmp_unsigned('<', tag, T_I32(RUNTIME_TYPES['string']))),
+        copy, done)
+    builder.position_at_end(copy)
+    primitive = builder.call(malloc, [T_I64(8)])
+    builder.store(builder.load(builder.bitcast(ptr, T_I32.as_pointer())),
+                  builder.bitcast(primitive, T_I32.as_pointer()))
+    builder.branch(done)
+    builder.position_at_end(done)
+    phi = builder.phi(T_VOID_PTR)
+    phi.add_incoming(ptr, entry)
+    phi.add_incoming(primitive, copy)
+    builder.store(phi, builder.gep(value, [T_I32(0), T_I32(1)]))
+    builder.ret(value)
+
+    fn = env.lib['make_int']
+    builder = ir.IRBuilder(fn.append_basic_block('entry'))
+    slot = builder.alloca(T_I32)
+    builder.store(fn.args[0], slot)
+    builder.ret(builder.call(env.lib['make_value'], [
+        T_I32(RUNTIME_TYPES['int']), builder.bitcast(slot, T_VOID_PTR)]))
+
+    fn = env.lib['value_truthy']
+    value, = fn.args
+    builder = ir.IRBuilder(fn.append_basic_block('entry'))
+    tag = builder.load(builder.gep(value, [T_I32(0), T_I32(0)]))
+    ptr = builder.load(builder.gep(value, [T_I32(0), T_I32(1)]))
+    switch = builder.switch(tag, fn.append_basic_block('default'))
+    with builder.goto_block(switch.default):
+        builder.ret(T_BOOL(True))
+    cases = {
+        'nil': lambda: T_BOOL(False),
+        'bool': lambda: builder.trunc(builder.load(ptr), T_BOOL),
+        'int': lambda: builder.icmp_signed('>', builder.load(
+            builder.bitcast(ptr, T_I32.as_pointer())), T_I32(0)),
+        'float': lambda: builder.fcmp_ordered('>', builder.load(
+            builder.bitcast(ptr, T_F32.as_pointer())), T_F32(0)),
+        # Non-empty strings.
+        'string': lambda: builder.icmp_unsigned('!=', builder.load(ptr),
+                                                T_I8(0)),
+    }
+    for name, truthy in cases.items():
+        block = fn.append_basic_block(name)
+        switch.add_case(T_I32(RUNTIME_TYPES[name]), block)
+        builder.position_at_end(block)
+        builder.ret(truthy())
+
+    fuel = ir.GlobalVariable(module, T_I64, 'fuel')
+    fuel.initializer = T_I64(0)
+    trap = ir.Function(module, ir.FunctionType(T_VOID, []), name='llvm.trap')
+    fn = ir.Function(module, ir.FunctionType(T_VOID, []), name='burn')
+    fn.linkage = 'internal'
+    builder = ir.IRBuilder(fn.append_basic_block('entry'))
+    left = builder.sub(builder.load(fuel), T_I64(1))
+    builder.store(left, fuel)
+    with builder.if_then(builder.icmp_signed('<', left, T_I64(0)),
+                         likely=False):
+        builder.call(trap, [])
+    builder.ret_void()
+
+def compile_evaluator(pure, calls):
+    """
+    Compiles the pure functions, a dict of name to defun form, and a
+    function eval.N for the Nth call, returning its value.
+    """
+    module = ir.Module(name='evaluate')
+    module.triple = llvm.get_default_triple()
+    fn_type = ir.FunctionType(T_VALUE_STRUCT_PTR, [])
+    fns = [ir.Function(module, fn_type, name='eval.{}'.format(i))
+           for i in range(len(calls))]
+    env = Environment(module, fns[0].append_basic_block('entry'))
+    compile_runtime_declarations(env)
+    env.declare_fn('value_truthy', T_BOOL, [T_VALUE_STRUCT_PTR])
+    compile_eval_runtime(env)
+    env.static_functions = {name: len(form[2]) for name, form in pure.items()}
+    burn = module.get_global('burn')
+    for name, form in pure.items():
+        fn = compile_lambda_function(env, List(form[:1] + form[2:]), name=name)
+        # The loop header is where calls & recur arrive, after its phis.
+        loop_block = fn.blocks[1]
+        builder = ir.IRBuilder(loop_block)
+        builder.position_before(loop_block.instructions[len(fn.args)])
+        builder.call(burn, [])
+    fuel = module.get_global('fuel')
+    for i, (fn, call) in enumerate(zip(fns, calls)):
+        if 0 < i:
+            env.add_block('entry', fn=fn)
+        env.builder.store(T_I64(conf.EVALUATE_STEPS), fuel)
+        env.builder.ret(env.box(compile_expression(env, call)))
+    return module
+
+class Value(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_int32), ('value', ctypes.c_void_p)]
+
+RUNTIME_TYPE_NAMES = {tag: name for name, tag in RUNTIME_TYPES.items()}
+
+VALUE_READERS = {
+    'nil': lambda ptr: None,
+    'bool': lambda ptr: ctypes.c_bool.from_address(ptr).value,
+    'int': lambda ptr: ctypes.c_int32.from_address(ptr).value,
+    'float': lambda ptr: ctypes.c_float.from_address(ptr).value,
+    'char': lambda ptr: ctypes.c_int32.from_address(ptr).value,
+    'string': lambda ptr: ctypes.string_at(ptr).decode('utf8'),
+    'keyword': lambda ptr: ctypes.string_at(ptr).decode('utf8'),
+}
+
+def read_value(address):
+    """
+    Returns a runtime value as a (type name, Python value) pair, or
+    None if it can't be a literal.
+    """
+    value = Value.from_address(address)
+    name = RUNTIME_TYPE_NAMES.get(value.type)
+    if name not in VALUE_READERS:
+        return None
+    return name, VALUE_READERS[name](value.value)
+
+LITERALS = {
+    'int': Int,
+    'float': Float,
+    'char': Char,
+    'string': Str,
+    'keyword': Keyword,
+}
+
+def literal(result, span):
+    """Returns the literal node for a value read by read_value."""
+    name, value = result
+    if 'nil' == name:
+        return NIL
+    if 'bool' == name:
+        return TRUE if value else FALSE
+    return LITERALS[name](value, span)
+
+def run_child(llvm_ir, start, count, fd):
+    """Runs calls start to count, writing a line per value to fd."""
+    # Calls which trap or overflow the stack are expected to crash it.
+    faulthandler.disable()
+    engine = compile_execution_engine()
+    finalize_module(engine, compile_module(llvm_ir))
+    os.write(fd, b'ready\n')
+    for i in range(start, count):
+        fn = ctypes.CFUNCTYPE(ctypes.c_void_p)(
+            engine.get_function_address('eval.{}'.format(i)))
+        os.write(fd, json.dumps(read_value(fn())).encode('utf8') + b'\n')
+
+def fork_calls(llvm_ir, start, count, deadline):
+    """
+    Runs calls from start in a child process, until the child dies or
+    runs out of time. Returns the values in order, or
+    None if the child did not get as far as running any.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if 0 == pid:
+        os.close(r)
+        try:
+            run_child(llvm_ir, start, count, w)
+        finally:
+            # Never return into the compiler, nor flush its buffers.
+            os._exit(0)
+    os.close(w)
+    buffer = b''
+
+    def readline():
+        nonlocal buffer
+        while b'\n' not in buffer:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or not select.select([r], [], [], timeout)[0]:
+                return None
+            chunk = os.read(r, 4096)
+            if not chunk:
+                return None
+            buffer += chunk
+        line, buffer = buffer.split(b'\n', 1)
+        return line
+
+    values = None
+    try:
+        if readline() is not None:
+            values = []
+            while start + len(values) < count:
+                line = readline()
+                if line is None:
+                    break
+                values.append(json.loads(line))
+    finally:
+        os.close(r)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        os.waitpid(pid, 0)
+    return values
+
+def run_calls(pure, calls, deadline, stop=False):
+    """
+    Evaluates calls, or only up to the first which fails if stop.
+    Returns a dict of call to result, or to None if it could not be
+    evaluated.
+    """
+    results = dict.fromkeys(calls)
+    # Only the functions the calls can reach need compiling.
+    reachable = dict()
+    stack = [call[0].name for call in calls]
+    while stack:
+        name = stack.pop()
+        if name in pure and name not in reachable:
+            reachable[name] = pure[name]
+            stack.extend(symbols(List(pure[name][3:])))
+    try:
+        llvm_ir = str(compile_evaluator(reachable, calls))
+    except Exception as e:
+        # Leave it to the compiler proper to report.
+        debug('could not compile calls for evaluation:', e)
+        return results
+    start = 0
+    while start < len(calls) and time.monotonic() < deadline:
+        values = fork_calls(llvm_ir, start, len(calls), deadline)
+        if values is None:
+            break
+        for call, value in zip(calls[start:], values):
+            results[call] = value
+        if stop and start + len(values) < len(calls):
+            break
+        # Skip the call which crashed or ran out of steps.
+        start += len(values) + 1
+    return results
+
+def evaluate(ast):
+    """
+    Evaluates calls to pure functions with literal arguments.
+    Returns a tuple of (AST, number of calls replaced).
+    """
+    if not hasattr(os, 'fork') or 0 >= conf.EVALUATE_TIMEOUT:
+        return ast, 0
+    pure = pure_functions(ast)
+    arity = {name: len(form[2]) for name, form in pure.items()}
+    deadline = time.monotonic() + conf.EVALUATE_TIMEOUT
+    failed = set()
+    replaced = 0
+
+    def collect(call):
+        if call not in failed:
+            calls.setdefault(call, None)
+        return call
+
+    def replace(call):
+        nonlocal replaced
+        result = results.get(call)
+        if result is None:
+            return call
+        replaced += 1
+        return literal(result, call.span)
+
+    while time.monotonic() < deadline:
+        calls = dict()
+        for form in ast:
+            map_calls(form, arity, collect)
+        if not calls:
+            break
+        results = run_calls(pure, list(calls), deadline)
+        failed.update(call for call, result in results.items()
+                      if result is None)
+        ast = [map_calls(form, arity, replace) for form in ast]
+        # Results can make more calls foldable.
+        ast, _ = simplify(ast)
+    debug('evaluate replaced', replaced, 'calls')
+    return ast, replaced
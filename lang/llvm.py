@@ -1,5 +1,27 @@
+import importlib.util
+import sys
+
 from llvmlite import ir
-import llvmlite.binding as llvm
+
+from lang.debug import timer
+
+def lazy_import(name):
+    """
+    Returns a module which is only loaded once one of its attributes
+    is used.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+# Loading the bindings loads libLLVM, which is most of our start-up
+# time, and not needed to parse arguments or build IR.
+llvm = lazy_import('llvmlite.binding')
 
 # Types
 T_VOID = ir.VoidType()
@@ -20,6 +42,11 @@ T_PRIMITIVE = ir.LiteralStructType([T_I64])
 T_PRIMITIVE_PTR = T_PRIMITIVE.as_pointer()
 T_FUNCTION = ir.LiteralStructType([T_VOID_PTR, T_VOID_PTR])
 T_FUNCTION_PTR = T_FUNCTION.as_pointer()
+# A number only known at runtime to be an int or a float: whether it
+# is a float, and its value as an int & as a float.
+T_NUMBER = ir.LiteralStructType([T_BOOL, T_I64, T_F64])
+# A hash map entry, the key's hash, the key & the value.
+T_ENTRY = ir.LiteralStructType([T_I64, T_VALUE_STRUCT_PTR, T_VALUE_STRUCT_PTR])
 
 # Values
 NULL_PTR = T_I32(0).inttoptr(T_VOID_PTR)
@@ -45,23 +72,61 @@ FFI_TYPE_MAPPING = {
     T_VOID_PTR.as_pointer(): 132,
 }
 
+# Optimisation levels as (speed, size, inlining threshold). The
+# thresholds are the ones clang uses for the same flags.
+OPT_LEVELS = {
+    '0': (0, 0, 0),
+    '1': (1, 0, 75),
+    '2': (2, 0, 225),
+    '3': (3, 0, 275),
+    's': (2, 1, 75),
+    'z': (2, 2, 25),
+}
+
+# Output kinds we can emit, and their file extensions.
+EMIT_KINDS = {
+    'obj': '.o',
+    'bc': '.bc',
+    'asm': '.s',
+    'll': '.ll',
+}
+
+_initialised = False
+
 def init_llvm():
-    """Setup the LLVM core."""
-    llvm.initialize()
-    llvm.initialize_native_target()
-    llvm.initialize_native_asmprinter()
+    """Setup the LLVM core, unless it already is."""
+    global _initialised
+    if _initialised:
+        return
+    with timer.phase('init_llvm'):
+        llvm.initialize()
+        llvm.initialize_native_target()
+        llvm.initialize_native_asmprinter()
+    _initialised = True
 
 def deinit_llvm():
     """Shutdown the LLVM core."""
     # XXX this currently breaks, and I'm unclear if we need it.
     llvm.shutdown()
 
+def compile_target_machine(level='0'):
+    """
+    Compile a target machine for emitting position-independent code
+    for the host, to be linked with the runtime.
+    """
+    init_llvm()
+    speed, _, _ = OPT_LEVELS[level]
+    target = llvm.Target.from_default_triple()
+    return target.create_target_machine(opt=speed, reloc='pic',
+                                        codemodel='default')
+
 def compile_execution_engine():
     """
     Compile an ExecutionEngine suitable for JIT code generation on
     the host CPU.  The engine is reusable for an arbitrary number of
     modules.
     """
+    init_llvm()
     # Compile a target machine representing the host
     target = llvm.Target.from_default_triple()
     target_machine = target.create_target_machine()
@@ -70,15 +135,187 @@ def compile_execution_engine():
     engine = llvm.create_mcjit_compiler(backing_mod, target_machine)
     return engine
 
-def compile_ir(engine, llvm_ir):
+def optimise_dev(mod, inlining_threshold):
+    """
+    A short pipeline of cheap passes for development builds. Promotes
+    stack slots to registers, inlines small functions and cleans up
+    after the boxing calls, but skips the expensive loop & vectorisation
+    passes.
+    """
+    pm = llvm.create_module_pass_manager()
+    pm.add_sroa_pass()
+    pm.add_instruction_combining_pass()
+    pm.add_cfg_simplification_pass()
+    pm.add_function_inlining_pass(inlining_threshold)
+    pm.add_sroa_pass()
+    pm.add_instruction_combining_pass()
+    pm.add_dead_code_elimination_pass()
+    pm.run(mod)
+
+def optimise_release(mod, speed, size, inlining_threshold):
+    """
+    LLVM's full pipeline for the given level, as clang would run it.
+    """
+    pmb = llvm.create_pass_manager_builder()
+    pmb.opt_level = speed
+    pmb.size_level = size
+    pmb.inlining_threshold = inlining_threshold
+    pmb.loop_vectorize = 0 == size
+    pmb.slp_vectorize = 3 == speed
+
+    fpm = llvm.create_function_pass_manager(mod)
+    pmb.populate(fpm)
+    fpm.initialize()
+    for fn in mod.functions:
+        if not fn.is_declaration:
+            fpm.run(fn)
+    fpm.finalize()
+
+    mpm = llvm.create_module_pass_manager()
+    pmb.populate(mpm)
+    # Our IR is mostly boxed values passed through runtime calls, so
+    # run another round of redundancy & loop-invariant code removal
+    # once everything has been inlined.
+    mpm.add_gvn_pass()
+    mpm.add_licm_pass()
+    mpm.add_cfg_simplification_pass()
+    mpm.run(mod)
+
+def optimise_module(mod, level):
+    """
+    Optimise the parsed module in place. -O1 runs the fast development
+    pipeline, -O2 and up (including -Os & -Oz) the full one.
+    """
+    speed, size, inlining_threshold = OPT_LEVELS[level]
+    if 0 == speed:
+        return mod
+    with timer.phase('optimise'):
+        if 1 == speed:
+            optimise_dev(mod, inlining_threshold)
+        else:
+            optimise_release(mod, speed, size, inlining_threshold)
+    return mod
+
+def optimise_linked(mod, level):
+    """
+    Interprocedural clean-up after linking separately optimised units,
+    which is much cheaper than running the whole pipeline again.
+    Inlines across unit boundaries and drops whatever is unused.
+    """
+    speed, _, inlining_threshold = OPT_LEVELS[level]
+    if 0 == speed:
+        return mod
+    with timer.phase('optimise linked'):
+        pm = llvm.create_module_pass_manager()
+        pm.add_function_inlining_pass(inlining_threshold)
+        pm.add_instruction_combining_pass()
+        pm.add_cfg_simplification_pass()
+        pm.add_global_dce_pass()
+        pm.add_constant_merge_pass()
+        pm.run(mod)
+    return mod
+
+# What the runtime calls into, which a whole program has to keep.
+ENTRY_POINTS = ('main', 'usercode_main')
+
+def minimise_module(mod):
+    """
+    Treats the module as the whole program: internalises everything
+    but the entry points, and drops whatever they do not reach,
+    including unused FFI declarations. Internal functions are also
+    fair game for the optimiser to inline & specialise.
+    """
+    with timer.phase('minimise'):
+        before = len([f for f in mod.functions if not f.is_declaration])
+        for value in list(mod.functions) + list(mod.global_variables):
+            if not value.is_declaration and value.name not in ENTRY_POINTS \
+               and llvm.Linkage.external == value.linkage:
+                value.linkage = llvm.Linkage.internal
+        pm = llvm.create_module_pass_manager()
+        pm.add_global_dce_pass()
+        pm.add_constant_merge_pass()
+        pm.add_strip_dead_prototypes_pass()
+        pm.run(mod)
+        after = len([f for f in mod.functions if not f.is_declaration])
+    timer.count('dropped functions', before - after)
+    return mod
+
+def link_runtime(mod, path):
+    """
+    Links the runtime, compiled to bitcode or textual IR at path, into
+    the module, so the optimiser can inline its small functions into
+    user code. The result must not be linked against the runtime
+    objects again.
+    """
+    with timer.phase('link runtime'):
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        if path.endswith('.bc'):
+            runtime = llvm.parse_bitcode(data)
+        else:
+            runtime = llvm.parse_assembly(data.decode('utf8'))
+        runtime.data_layout = mod.data_layout
+        mod.triple = mod.triple or runtime.triple
+        runtime.triple = mod.triple
+        mod.link_in(runtime)
+    return mod
+
+def compile_module(llvm_ir, level='0', target_machine=None, minimal=False,
+                   runtime=None):
+    """
+    Parse, verify & optimise the LLVM module string.
+    The resulting module object is returned.
+    """
+    with timer.phase('parse_assembly'):
+        mod = llvm.parse_assembly(llvm_ir)
+    return prepare_module(mod, level, target_machine, minimal, runtime)
+
+def prepare_module(mod, level='0', target_machine=None, minimal=False,
+                   runtime=None):
+    """
+    Verify & optimise a parsed module object, for the target machine
+    if given. If minimal, the module is the whole program, see
+    minimise_module. runtime is the path of the runtime's bitcode to
+    link in first, if any, see link_runtime.
+    """
+    if target_machine:
+        mod.data_layout = str(target_machine.target_data)
+    if runtime:
+        link_runtime(mod, runtime)
+    with timer.phase('verify'):
+        mod.verify()
+    if minimal:
+        minimise_module(mod)
+    return optimise_module(mod, level)
+
+def finalize_module(engine, mod):
+    """
+    Add the module to the engine and make sure it is ready for
+    execution.
+    """
+    with timer.phase('finalize_object'):
+        engine.add_module(mod)
+        engine.finalize_object()
+        engine.run_static_constructors()
+    return mod
+
+def emit(target_machine, mod, kind):
+    """
+    Emit the module as one of EMIT_KINDS, straight from memory.
+    Returns bytes.
+    """
+    with timer.phase('emit ' + kind):
+        if 'obj' == kind:
+            return target_machine.emit_object(mod)
+        if 'bc' == kind:
+            return mod.as_bitcode()
+        if 'asm' == kind:
+            return target_machine.emit_assembly(mod).encode('utf8')
+        return str(mod).encode('utf8')
+
+def compile_ir(engine, llvm_ir, level='0'):
     """
     Compile the LLVM module string with the given engine.
     The compiled module object is returned.
     """
-    mod = llvm.parse_assembly(llvm_ir)
-    mod.verify()
-    # Now add the mod and make sure it is ready for execution
-    engine.add_module(mod)
-    engine.finalize_object()
-    engine.run_static_constructors()
-    return mod
+    return finalize_module(engine, compile_module(llvm_ir, level))
@@ -0,0 +1,73 @@
+"""
+Memoisation of pure functions, with --memoise.
+
+Pure functions which recurse or loop, directly or through the pure
+functions they call, are compiled behind a memo table, see
+compiler.compile_memoised. Cheaper ones are faster to just call.
+
+Those of a single argument also get a lookup table of their results
+for 0 up to MEMO_TABLE_SIZE, evaluated at compile time like in
+lang.evaluate. It ends before the first result which can't be
+evaluated, e.g. as it runs out of steps.
+"""
+import os
+import time
+
+from lang import conf
+from lang.debug import debug
+from lang.evaluate import literal, run_calls
+from lang.nodes import Int, List, Symbol
+from lang.resolve import pure_functions
+from lang.units import symbols
+
+def expensive_functions(pure):
+    """
+    Returns the names of the pure functions, a dict of name to defun
+    form, which recurse or loop.
+    """
+    calls = dict()
+    expensive = set()
+    for name, form in pure.items():
+        body = list(symbols(List(form[3:])))
+        calls[name] = set(body) & set(pure)
+        if name in body or 'recur' in body:
+            expensive.add(name)
+    changed = True
+    while changed:
+        changed = False
+        for name in set(pure) - expensive:
+            if calls[name] & expensive:
+                expensive.add(name)
+                changed = True
+    return expensive
+
+def lookup_table(pure, name, deadline):
+    """
+    Returns the results of a function of one argument for 0 and up, as
+    literals, or None if there are none.
+    """
+    calls = [List([Symbol(name), Int(i)])
+             for i in range(conf.MEMO_TABLE_SIZE)]
+    results = run_calls(pure, calls, deadline, stop=True)
+    table = []
+    for call in calls:
+        if results[call] is None:
+            break
+        table.append(literal(results[call], None))
+    return table or None
+
+def memo_tables(ast):
+    """
+    Returns a dict of the names of the functions to memoise to their
+    lookup tables, or None.
+    """
+    pure = pure_functions(ast)
+    memo = dict.fromkeys(expensive_functions(pure))
+    if not hasattr(os, 'fork') or 0 >= conf.EVALUATE_TIMEOUT:
+        return memo
+    deadline = time.monotonic() + conf.EVALUATE_TIMEOUT
+    for name in sorted(memo):
+        if 1 == len(pure[name][2]) and time.monotonic() < deadline:
+            memo[name] = lookup_table(pure, name, deadline)
+            debug('lookup table for', name, memo[name])
+    return memo
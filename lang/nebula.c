@@ -2,6 +2,7 @@
 #include <stdlib.h>
 #include <stdio.h>
 #include <stdbool.h>
+#include <stdint.h>
 #include <string.h>
 #include <time.h>
 
@@ -13,6 +14,8 @@ int usercode_main(int, char**);
 struct Value* cons(struct Value*, struct Value*);
 struct Value* cdr(struct Value*);
 struct Value* car(struct Value*);
+void init_small_ints();
+static bool collections_equal(struct Value*, struct Value*);
 
 void nebula_debug(void* x) {
   printf("[DEBUG] base 10: %u; base 16: %X\n", (unsigned int)x, (unsigned int)x);
@@ -22,6 +25,7 @@ void nebula_debug(void* x) {
 
 void init_nebula() {
   srand(time(NULL));
+  init_small_ints();
   /* puts("Nebula initalised."); */
 }
 
@@ -66,6 +70,25 @@ struct Function {
   void* fn_ptr;
 };
 
+// Vectors & hash maps are stored in one allocation with the value
+// pointing at them, see make_vector. Hash maps keep their entries
+// sorted by the hash of their key, without duplicate keys.
+struct Vector {
+  uint32_t count;
+  struct Value* items[];
+};
+
+struct Entry {
+  uint64_t hash;
+  struct Value* key;
+  struct Value* value;
+};
+
+struct HashMap {
+  uint32_t count;
+  struct Entry entries[];
+};
+
 struct Value* make_value(enum Type type, union Primitive* value) {
   struct Value* retval = malloc(sizeof(struct Value));
   if (NULL == retval) {
@@ -102,6 +125,31 @@ struct Value* make_value(enum Type type, union Primitive* value) {
   return retval;
 }
 
+// Small ints are preboxed, so boxing them does not allocate. Values
+// are never mutated, so they can be shared.
+#define SMALL_INT_MIN -5
+#define SMALL_INT_MAX 256
+
+union Primitive small_int_primitives[SMALL_INT_MAX - SMALL_INT_MIN + 1];
+struct Value small_ints[SMALL_INT_MAX - SMALL_INT_MIN + 1];
+
+void init_small_ints() {
+  for (int i = SMALL_INT_MIN; i <= SMALL_INT_MAX; i++) {
+    small_int_primitives[i - SMALL_INT_MIN].i = i;
+    small_ints[i - SMALL_INT_MIN].type = INT;
+    small_ints[i - SMALL_INT_MIN].value = &small_int_primitives[i - SMALL_INT_MIN];
+  }
+}
+
+struct Value* make_int(int i) {
+  if ((SMALL_INT_MIN <= i) && (i <= SMALL_INT_MAX)) {
+    return &small_ints[i - SMALL_INT_MIN];
+  }
+  union Primitive u;
+  u.i = i;
+  return make_value(INT, &u);
+}
+
 enum Type value_type(struct Value* value) {
   return value->type;
 }
@@ -125,7 +173,7 @@ struct Value* make_function(char* name, void* fn_ptr) {
   return make_value(FUNCTION, u);
 }
 
-struct Value* value_equal(struct Value* a, struct Value* b) {
+bool values_equal(struct Value* a, struct Value* b) {
   bool result;
 
   if (a->type != b->type) {
@@ -153,18 +201,30 @@ struct Value* value_equal(struct Value* a, struct Value* b) {
     case STRING:
       result = (0 == strcmp((char*)a->value, (char*)b->value));
       break;
+    case KEYWORD:
+      result = (0 == strcmp((char*)a->value, (char*)b->value));
+      break;
     case CONS:
-      result = (value_equal(car(a), car(b)) && value_equal(cdr(a), cdr(b)));
+      result = (values_equal(car(a), car(b)) && values_equal(cdr(a), cdr(b)));
       break;
     case FUNCTION:
       result = (((struct Function*)a->value->ptr)->name == ((struct Function*)b->value->ptr)->name);
       break;
+    case VECTOR:
+    case HASH_MAP:
+      result = collections_equal(a, b);
+      break;
     default:
       result = false;
       break;
     }
   }
 
+  return result;
+}
+
+struct Value* value_equal(struct Value* a, struct Value* b) {
+  bool result = values_equal(a, b);
   union Primitive* u = calloc(1, sizeof(union Primitive));
   u->b = result;
   return make_value(BOOL, u);
@@ -312,12 +372,32 @@ void print_value(struct Value* value) {
   case POINTER:
     printf("<ptr: %X>", (uint32_t)value->value->ptr);
     break;
-  case VECTOR:
-    printf("<vector: %X>", (uint32_t)value->value);
+  case VECTOR: {
+    struct Vector* vector = (struct Vector*)value->value;
+    printf("[");
+    for (uint32_t i = 0; i < vector->count; ++i) {
+      if (0 < i) {
+        printf(" ");
+      }
+      print_value(vector->items[i]);
+    }
+    printf("]");
     break;
-  case HASH_MAP:
-    printf("<hash-map: %X>", (uint32_t)value->value);
+  }
+  case HASH_MAP: {
+    struct HashMap* map = (struct HashMap*)value->value;
+    printf("{");
+    for (uint32_t i = 0; i < map->count; ++i) {
+      if (0 < i) {
+        printf(" ");
+      }
+      print_value(map->entries[i].key);
+      printf(" ");
+      print_value(map->entries[i].value);
+    }
+    printf("}");
     break;
+  }
   case KEYWORD:
     printf(":%s", (char *)(value->value));
     break;
@@ -511,6 +591,262 @@ struct Value* array(const int t, const struct Value* l) {
   return rv;
 }
 
+/* Vectors & hash maps
+
+The compiler builds literals with every item known at compile time as
+constants, and everything else with one of the make_ functions, which
+allocate the value & all of its items at once. The compiler then
+stores the items, and has the runtime sort hash maps by hash_map_index.
+Values are never mutated, so value_assoc returns a copy.
+ */
+
+static struct Value* make_collection(enum Type type, size_t size) {
+  struct Value* retval = malloc(sizeof(struct Value) + size);
+  if (NULL == retval) {
+    exit(ENOMEM);
+  }
+  retval->type = type;
+  retval->value = (union Primitive*)(retval + 1);
+  return retval;
+}
+
+struct Value* make_vector(uint32_t count) {
+  struct Value* retval = make_collection(
+      VECTOR, sizeof(struct Vector) + count * sizeof(struct Value*));
+  ((struct Vector*)retval->value)->count = count;
+  return retval;
+}
+
+struct Value* make_hash_map(uint32_t count) {
+  struct Value* retval = make_collection(
+      HASH_MAP, sizeof(struct HashMap) + count * sizeof(struct Entry));
+  ((struct HashMap*)retval->value)->count = count;
+  return retval;
+}
+
+// 64 bit FNV-1a, over the type & the bytes of the payload, with
+// numbers in little endian. lang.compiler hashes the keys of constant
+// hash maps the same way, so both have to be kept in sync.
+#define FNV_OFFSET 14695981039346656037ULL
+#define FNV_PRIME 1099511628211ULL
+
+static uint64_t fnv_byte(uint64_t hash, unsigned char byte) {
+  return (hash ^ byte) * FNV_PRIME;
+}
+
+static uint64_t fnv_u32(uint64_t hash, uint32_t n) {
+  for (int i = 0; i < 4; ++i) {
+    hash = fnv_byte(hash, (n >> (8 * i)) & 0xff);
+  }
+  return hash;
+}
+
+uint64_t value_hash(struct Value* value) {
+  uint64_t hash = fnv_byte(FNV_OFFSET, value->type);
+  uint32_t bits;
+  switch (value->type) {
+  case BOOL:
+    return fnv_byte(hash, value->value->b);
+  case INT:
+  case CHAR:
+  case TYPE:
+    return fnv_u32(hash, value->value->i);
+  case FLOAT:
+    memcpy(&bits, &value->value->f, sizeof(bits));
+    return fnv_u32(hash, bits);
+  case STRING:
+  case KEYWORD:
+    for (unsigned char* c = (unsigned char*)value->value; *c; ++c) {
+      hash = fnv_byte(hash, *c);
+    }
+    return hash;
+  default:
+    return hash;
+  }
+}
+
+// Sorts the entries of a freshly built hash map by hash & drops all
+// but the last of duplicate keys, like assoc-ing them in order. The
+// sort is a stable merge sort, so duplicates stay in order.
+void hash_map_index(struct Value* value) {
+  struct HashMap* map = (struct HashMap*)value->value;
+  uint32_t count = map->count;
+  for (uint32_t i = 0; i < count; ++i) {
+    map->entries[i].hash = value_hash(map->entries[i].key);
+  }
+  struct Entry* from = map->entries;
+  struct Entry* to = malloc(count * sizeof(struct Entry));
+  if ((NULL == to) && (0 < count)) {
+    exit(ENOMEM);
+  }
+  struct Entry* buffer = to;
+  for (uint32_t width = 1; width < count; width *= 2) {
+    for (uint32_t start = 0; start < count; start += 2 * width) {
+      uint32_t middle = (start + width < count) ? start + width : count;
+      uint32_t end = (middle + width < count) ? middle + width : count;
+      uint32_t i = start, j = middle, k = start;
+      while ((i < middle) && (j < end)) {
+        to[k++] = (from[j].hash < from[i].hash) ? from[j++] : from[i++];
+      }
+      while (i < middle) {
+        to[k++] = from[i++];
+      }
+      while (j < end) {
+        to[k++] = from[j++];
+      }
+    }
+    struct Entry* swap = from;
+    from = to;
+    to = swap;
+  }
+  if (from != map->entries) {
+    memcpy(map->entries, from, count * sizeof(struct Entry));
+  }
+  free(buffer);
+  uint32_t kept = 0;
+  for (uint32_t i = 0; i < count; ++i) {
+    bool replaced = false;
+    for (uint32_t j = i + 1;
+         (j < count) && (map->entries[j].hash == map->entries[i].hash); ++j) {
+      if (values_equal(map->entries[i].key, map->entries[j].key)) {
+        replaced = true;
+        break;
+      }
+    }
+    if (!replaced) {
+      map->entries[kept++] = map->entries[i];
+    }
+  }
+  map->count = kept;
+}
+
+// Returns the index of the first entry with a hash of at least hash.
+static uint32_t hash_map_bound(struct HashMap* map, uint64_t hash) {
+  uint32_t low = 0;
+  uint32_t high = map->count;
+  while (low < high) {
+    uint32_t middle = low + (high - low) / 2;
+    if (map->entries[middle].hash < hash) {
+      low = middle + 1;
+    } else {
+      high = middle;
+    }
+  }
+  return low;
+}
+
+// Returns the index of key, or of the end of the run of entries with
+// the same hash if it is not in the map.
+static uint32_t hash_map_find(struct HashMap* map, struct Value* key, uint64_t hash) {
+  uint32_t i = hash_map_bound(map, hash);
+  while ((i < map->count) && (hash == map->entries[i].hash)
+         && !values_equal(key, map->entries[i].key)) {
+    ++i;
+  }
+  return i;
+}
+
+static bool hash_map_has(struct HashMap* map, uint32_t i, uint64_t hash) {
+  return (i < map->count) && (hash == map->entries[i].hash);
+}
+
+// Looks up an index in a vector, or a key in a hash map. Returns nil
+// if there is none.
+struct Value* value_get(struct Value* coll, struct Value* key) {
+  if (VECTOR == coll->type) {
+    struct Vector* vector = (struct Vector*)coll->value;
+    if ((INT == key->type) && (0 <= key->value->i)
+        && ((uint32_t)key->value->i < vector->count)) {
+      return vector->items[key->value->i];
+    }
+  } else if (HASH_MAP == coll->type) {
+    struct HashMap* map = (struct HashMap*)coll->value;
+    uint64_t hash = value_hash(key);
+    uint32_t i = hash_map_find(map, key, hash);
+    if (hash_map_has(map, i, hash)) {
+      return map->entries[i].value;
+    }
+  }
+  return make_value(NIL, NULL);
+}
+
+// Returns a copy of a vector with the item at an index replaced, or
+// appended if the index is the count, or of a hash map with a key set.
+// Returns nil for indices out of range & anything else.
+struct Value* value_assoc(struct Value* coll, struct Value* key, struct Value* value) {
+  if (VECTOR == coll->type) {
+    struct Vector* vector = (struct Vector*)coll->value;
+    if ((INT != key->type) || (key->value->i < 0)
+        || (vector->count < (uint32_t)key->value->i)) {
+      return make_value(NIL, NULL);
+    }
+    uint32_t i = key->value->i;
+    struct Value* retval = make_vector(
+        (i == vector->count) ? vector->count + 1 : vector->count);
+    struct Vector* copy = (struct Vector*)retval->value;
+    memcpy(copy->items, vector->items, vector->count * sizeof(struct Value*));
+    copy->items[i] = value;
+    return retval;
+  }
+  if (HASH_MAP == coll->type) {
+    struct HashMap* map = (struct HashMap*)coll->value;
+    uint64_t hash = value_hash(key);
+    uint32_t i = hash_map_find(map, key, hash);
+    bool replace = hash_map_has(map, i, hash);
+    struct Value* retval = make_hash_map(replace ? map->count : map->count + 1);
+    struct HashMap* copy = (struct HashMap*)retval->value;
+    memcpy(copy->entries, map->entries, i * sizeof(struct Entry));
+    copy->entries[i].hash = hash;
+    copy->entries[i].key = key;
+    copy->entries[i].value = value;
+    uint32_t rest = replace ? i + 1 : i;
+    memcpy(copy->entries + i + 1, map->entries + rest,
+           (map->count - rest) * sizeof(struct Entry));
+    return retval;
+  }
+  return make_value(NIL, NULL);
+}
+
+struct Value* value_count(struct Value* coll) {
+  switch (coll->type) {
+  case VECTOR:
+    return make_int(((struct Vector*)coll->value)->count);
+  case HASH_MAP:
+    return make_int(((struct HashMap*)coll->value)->count);
+  default:
+    return make_int(0);
+  }
+}
+
+static bool collections_equal(struct Value* a, struct Value* b) {
+  if (VECTOR == a->type) {
+    struct Vector* x = (struct Vector*)a->value;
+    struct Vector* y = (struct Vector*)b->value;
+    if (x->count != y->count) {
+      return false;
+    }
+    for (uint32_t i = 0; i < x->count; ++i) {
+      if (!values_equal(x->items[i], y->items[i])) {
+        return false;
+      }
+    }
+    return true;
+  }
+  struct HashMap* x = (struct HashMap*)a->value;
+  struct HashMap* y = (struct HashMap*)b->value;
+  if (x->count != y->count) {
+    return false;
+  }
+  for (uint32_t i = 0; i < x->count; ++i) {
+    uint32_t j = hash_map_find(y, x->entries[i].key, x->entries[i].hash);
+    if (!hash_map_has(y, j, x->entries[i].hash)
+        || !values_equal(x->entries[i].value, y->entries[j].value)) {
+      return false;
+    }
+  }
+  return true;
+}
+
 /* Pointers */
 
 struct Value* make_pointer() {
@@ -541,6 +877,52 @@ unsigned long hash(unsigned char* str) {
   return hash;
 }
 
+/* Memoisation statistics
+
+Memoised functions (see lang --memoise) register their hit & miss
+counters when they are defined. If NEBULA_MEMO_STATS is set, they are
+printed to stderr on exit.
+ */
+
+struct MemoStats {
+  char* name;
+  long* hits;
+  long* misses;
+  struct MemoStats* next;
+};
+
+struct MemoStats* memo_stats = NULL;
+
+void print_memo_stats() {
+  for (struct MemoStats* s = memo_stats; NULL != s; s = s->next) {
+    fprintf(stderr, "memo %s: %ld hits, %ld misses\n",
+            s->name, *s->hits, *s->misses);
+  }
+}
+
+void memo_register(char* name, long* hits, long* misses) {
+  if (NULL == getenv("NEBULA_MEMO_STATS")) {
+    return;
+  }
+  for (struct MemoStats* s = memo_stats; NULL != s; s = s->next) {
+    if (hits == s->hits) {
+      return;
+    }
+  }
+  if (NULL == memo_stats) {
+    atexit(print_memo_stats);
+  }
+  struct MemoStats* s = malloc(sizeof(struct MemoStats));
+  if (NULL == s) {
+    exit(ENOMEM);
+  }
+  s->name = name;
+  s->hits = hits;
+  s->misses = misses;
+  s->next = memo_stats;
+  memo_stats = s;
+}
+
 /* Testing */
 
 struct Value* random_bool() {
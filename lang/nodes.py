@@ -0,0 +1,157 @@
+"""
+AST nodes.
+
+The parser classifies every atom & decodes literals once, so the
+compiler can dispatch on node types. Nodes are immutable. Symbols are
+interned, there is only ever one node per name, which is also why
+they are the only nodes without a source span.
+
+Spans are (start, end) offsets into the source. They are stored as
+start & length, as most lengths are small ints, which Python shares.
+"""
+
+_set = object.__setattr__
+
+class Node:
+    __slots__ = ('start', 'length')
+
+    def __setattr__(self, name, value):
+        raise AttributeError('AST nodes are immutable')
+
+    @property
+    def span(self):
+        if self.start is None:
+            return None
+        return self.start, self.start + self.length
+
+    def __repr__(self):
+        return str(self)
+
+class Symbol(Node):
+    __slots__ = ('name',)
+    _interned = dict()
+
+    def __new__(cls, name):
+        symbol = cls._interned.get(name)
+        if symbol is None:
+            symbol = object.__new__(cls)
+            _set(symbol, 'name', name)
+            _set(symbol, 'start', None)
+            _set(symbol, 'length', None)
+            cls._interned[name] = symbol
+        return symbol
+
+    def __reduce__(self):
+        # Unpickle through the intern table, e.g. in worker processes.
+        return Symbol, (self.name,)
+
+    def __str__(self):
+        return self.name
+
+class Literal(Node):
+    """A decoded literal value."""
+    __slots__ = ('value',)
+
+    def __init__(self, value, span=None):
+        _set(self, 'value', value)
+        if span is None:
+            _set(self, 'start', None)
+            _set(self, 'length', None)
+        else:
+            _set(self, 'start', span[0])
+            _set(self, 'length', span[1] - span[0])
+
+    def __reduce__(self):
+        return type(self), (self.value, self.span)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.value == other.value
+
+    def __hash__(self):
+        return hash((type(self), self.value))
+
+    def __str__(self):
+        return str(self.value)
+
+class Int(Literal):
+    __slots__ = ()
+
+class Float(Literal):
+    __slots__ = ()
+
+    def __str__(self):
+        return repr(self.value)
+
+class Str(Literal):
+    __slots__ = ()
+
+    def __str__(self):
+        return '"{}"'.format(self.value.encode('unicode_escape')
+                             .decode('ascii').replace('"', '\\"'))
+
+# Chars with names, rather than the char after the backslash.
+CHAR_NAMES = {
+    'newline': '\n',
+    'space': ' ',
+    'tab': '\t',
+}
+
+class Char(Literal):
+    """A char, value is its code point."""
+    __slots__ = ()
+
+    def __str__(self):
+        for name, char in CHAR_NAMES.items():
+            if ord(char) == self.value:
+                return '\\' + name
+        return '\\' + chr(self.value)
+
+class Keyword(Literal):
+    """A keyword, value is its name without the colon."""
+    __slots__ = ()
+
+    def __str__(self):
+        return ':' + self.value
+
+class List(Node):
+    __slots__ = ('items',)
+
+    def __init__(self, items, span=None):
+        _set(self, 'items', tuple(items))
+        if span is None:
+            _set(self, 'start', None)
+            _set(self, 'length', None)
+        else:
+            _set(self, 'start', span[0])
+            _set(self, 'length', span[1] - span[0])
+
+    def __reduce__(self):
+        return List, (self.items, self.span)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.items == other.items
+
+    def __hash__(self):
+        return hash(self.items)
+
+    def __str__(self):
+        return '(' + ' '.join(str(item) for item in self.items) + ')'
+
+NIL = Symbol('nil')
+TRUE = Symbol('true')
+FALSE = Symbol('false')
+
+def head(form):
+    """Returns the name of the symbol a list starts with, or None."""
+    if isinstance(form, List) and form.items and isinstance(form.items[0], Symbol):
+        return form.items[0].name
+    return None
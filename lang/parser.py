@@ -1,59 +1,151 @@
+import re
+from ast import literal_eval
+
 from lang.conf import DEBUG
+from lang.nodes import (CHAR_NAMES, Char, Float, Int, Keyword, List, Str,
+                        Symbol)
+
+# One alternative per token kind, tried in order at the current offset.
+# Whitespace and comments are matched so they can be skipped, anything
+# left over (an unterminated string or a trailing backslash) is an
+# error.
+TOKEN_RE = re.compile(r'''
+    (?P<space>(?:\s+|;[^\n]*)+)
+  | (?P<open>[([{])
+  | (?P<close>[)\]}])
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<char>\\(?:space|tab|newline|.))
+  | (?P<atom>[^\s;"()[\]{}\\]+)
+  | (?P<error>.)
+''', re.VERBOSE | re.DOTALL)
+
+# The closing token each opening one expects, and the special form
+# the list is a call to. Vectors & hash maps are read as calls to
+# special forms named like their brackets, which can't be read as
+# symbols, so they never clash with user definitions.
+BRACKETS = {
+    '(': (')', None),
+    '[': (']', Symbol('[]')),
+    '{': ('}', Symbol('{}')),
+}
+
+INT_RE = re.compile(r'-?[0-9]+$')
+FLOAT_RE = re.compile(r'-?[0-9]+\.[0-9]+$')
+KEYWORD_RE = re.compile(r':[a-zA-Z_-]+$')
+
+def make_atom(kind, token, span):
+    """Classifies a token & decodes its value into a node."""
+    if 'string' == kind:
+        # Same escape sequences as Python.
+        return Str(literal_eval(token), span)
+    if 'char' == kind:
+        return Char(ord(CHAR_NAMES.get(token[1:], token[1:])), span)
+    if INT_RE.match(token):
+        return Int(int(token), span)
+    if FLOAT_RE.match(token):
+        return Float(float(token), span)
+    if KEYWORD_RE.match(token):
+        return Keyword(token[1:], span)
+    return Symbol(token)
 
-def parse(unparsed, depth=0):
+def tokenize(source):
     """
-    Parse nested S-expressions. Raises for unbalanced parens.
-    Returns a tuple of (unparsed, AST).
-    The top level is always a list.
+    Split source into tokens in a single pass over the buffer.
+    Yields tuples of (kind, text, offset), skipping whitespace and
+    comments.
+    """
+    for match in TOKEN_RE.finditer(source):
+        kind = match.lastgroup
+        if 'space' == kind:
+            continue
+        if 'error' == kind:
+            raise Exception('Unexpected EOF while parsing')
+        yield kind, match.group(), match.start()
+
+# Characters read at a time when streaming, and how far past a token
+# the tokenizer may have to look to be sure it is complete, which is
+# the longest char name.
+CHUNK_SIZE = 1 << 16
+LOOKAHEAD = len('\\newline')
+
+def tokenize_stream(fp, size=CHUNK_SIZE):
+    """
+    Like tokenize, but reads the source from a file object in chunks
+    of size characters. Tokens which might continue in the next chunk
+    are held back until it has been read.
     """
+    buffer = ''
+    base = 0
+    eof = False
+    while not eof:
+        chunk = fp.read(size)
+        eof = not chunk
+        buffer += chunk
+        consumed = 0
+        for match in TOKEN_RE.finditer(buffer):
+            kind = match.lastgroup
+            if not eof and ('error' == kind
+                            or len(buffer) - LOOKAHEAD < match.end()):
+                break
+            consumed = match.end()
+            if 'space' == kind:
+                continue
+            if 'error' == kind:
+                raise Exception('Unexpected EOF while parsing')
+            yield kind, match.group(), base + match.start()
+        buffer = buffer[consumed:]
+        base += consumed
+
+def read_forms(tokens):
+    """
+    Builds nodes from tokens. Yields top-level nodes as soon as they
+    are complete. Raises for unbalanced or mismatched parens.
+    """
+    # The parser keeps its own stack of open lists instead of
+    # recursing, so nesting depth is only bounded by memory.
     ast = []
-    inside_comment = False
-    inside_word = False
-    inside_string = False
-    while unparsed:
-        c = unparsed[0]
-        unparsed = unparsed[1:]
-        if inside_comment:
-            if '\n' == c:
-                inside_comment = False
-        elif '\\' == c and not inside_string:
-            for literal in ['space', 'tab', 'newline']:
-                # Some literals are multiple chars
-                if unparsed.startswith(literal):
-                    ast += [c + unparsed[:len(literal)]]
-                    unparsed = unparsed[len(literal):]
-                    break
-            else:
-                # Else just take a char and call it done
-                ast += [c + unparsed[0]]
-                unparsed = unparsed[1:]
-        elif ';' == c:
-            inside_comment = True
-        elif '"' == c:
-            if inside_string:
-                ast[-1] += c
-            else:
-                ast += [c]
-            inside_string = not inside_string
-        elif inside_string:
-            ast[-1] += c
-        elif '(' == c:
-            unparsed, inner_ast = parse(unparsed, depth=depth+1)
-            ast += [inner_ast]
-        elif ')' == c:
-            if depth == 0:
-                raise Exception('Unexpected ) while parsing')
-            return unparsed, ast
-        elif c.isspace():
-            inside_word = False
-        elif inside_word:
-            ast[-1] += c
+    stack = []
+    symbols = Symbol._interned
+    for kind, token, offset in tokens:
+        # Most atoms are symbols we have seen before.
+        if 'atom' == kind and token in symbols:
+            ast.append(symbols[token])
+        elif 'open' == kind:
+            stack.append((ast, offset, token))
+            _, builder = BRACKETS[token]
+            ast = [] if builder is None else [builder]
+        elif 'close' == kind:
+            if not stack or BRACKETS[stack[-1][2]][0] != token:
+                raise Exception('Unexpected {} while parsing'.format(token))
+            inner_ast = ast
+            ast, start, _ = stack.pop()
+            ast.append(List(inner_ast, (start, offset + 1)))
+            if not stack:
+                yield from ast
+                ast = []
         else:
-            inside_word = True
-            ast += c
-    if depth != 0:
+            ast.append(make_atom(kind, token, (offset, offset + len(token))))
+    if stack:
         raise Exception('Unexpected EOF while parsing')
+    yield from ast
+
+def parse_forms(fp, size=CHUNK_SIZE):
+    """
+    Parses the source in a file object, reading it in chunks. Yields
+    top-level nodes one at a time, so neither the whole source nor the
+    whole AST have to be in memory at once.
+    """
+    return read_forms(tokenize_stream(fp, size))
+
+def parse(unparsed):
+    """
+    Parse nested S-expressions into nodes. Raises for unbalanced
+    parens.
+    Returns a tuple of (unparsed, AST).
+    The top level is always a Python list of nodes.
+    """
+    ast = list(read_forms(tokenize(unparsed)))
     if DEBUG:
         from pprint import pprint
         pprint(ast)
-    return unparsed, ast
+    return '', ast
@@ -0,0 +1,183 @@
+"""
+The REPL.
+
+Keeps a single MCJIT engine alive for the whole session. Every form
+entered is compiled as a unit of its own (see lang.units) into a
+small module, which is added to the engine & run straight away.
+Globals are defined by the module of the form that first defines
+them, so later modules resolve them by name.
+
+The runtime has to be loaded into the process as a shared library,
+see the libnebula.so make target.
+"""
+import ctypes
+import sys
+
+from lang.compiler import RUNTIME_TYPES
+from lang.debug import timer
+from lang.llvm import *
+from lang.parser import parse
+from lang.simplify import simplify
+from lang.units import Interface, compile_unit, global_name
+
+try:
+    # Line editing & history, where available.
+    import readline
+except ImportError:
+    pass
+
+PROMPT = 'lang> '
+CONTINUATION = '...   '
+
+class Session:
+    """A REPL session, evaluating forms in one JIT engine."""
+    def __init__(self, runtime, level='0'):
+        init_llvm()
+        llvm.load_library_permanently(runtime)
+        self.engine = compile_execution_engine()
+        self.level = level
+        # Nothing is static in a REPL, as anything can be redefined.
+        self.interface = Interface()
+        self.defined = set()
+        self.count = 0
+        self.print_value = ctypes.CFUNCTYPE(None, ctypes.c_void_p)(
+            llvm.address_of_symbol('print_value'))
+        self.fflush = ctypes.CDLL(None).fflush
+        ctypes.CFUNCTYPE(None)(llvm.address_of_symbol('init_nebula'))()
+        self.bind_argv()
+
+    def bind_argv(self):
+        """
+        Defines argv, which every unit can refer to, as nil, as there
+        are no program arguments.
+        """
+        module = ir.Module(name='repl_argv')
+        module.triple = llvm.get_default_triple()
+        nil = ir.GlobalVariable(module, T_VALUE_STRUCT, 'const.nil')
+        nil.initializer = T_VALUE_STRUCT([T_I32(RUNTIME_TYPES['nil']),
+                                          NULL_PTR])
+        nil.global_constant = True
+        nil.linkage = 'linkonce_odr'
+        argv = ir.GlobalVariable(module, T_VALUE_STRUCT_PTR,
+                                 global_name('argv'))
+        argv.initializer = nil
+        finalize_module(self.engine, compile_module(str(module)))
+        self.defined.add('argv')
+
+    def snapshot(self):
+        interface = self.interface
+        return (dict(interface.declares), set(interface.globals),
+                dict(interface.defined_by), set(self.defined), self.count)
+
+    def restore(self, snapshot):
+        (self.interface.declares, self.interface.globals,
+         self.interface.defined_by, self.defined, self.count) = snapshot
+
+    def compile(self, form):
+        """
+        Compiles a form into a module. Returns the module & the name
+        of the function evaluating the form.
+        """
+        unit = self.interface.add(form)
+        # Unit names are content-addressed, but the same form can be
+        # entered more than once.
+        name = 'repl_{}'.format(self.count)
+        module = compile_unit(unit, name)
+        for var in unit.globals:
+            if var not in self.defined:
+                gv = module.get_global(global_name(var))
+                gv.initializer = ir.Constant(T_VALUE_STRUCT_PTR, None)
+                self.defined.add(var)
+        # Functions are only reached through their boxed values, so
+        # they can be redefined later.
+        for fn in module.functions:
+            if not fn.is_declaration and name != fn.name:
+                fn.linkage = 'internal'
+        self.count += 1
+        return module, name
+
+    def eval(self, form):
+        """Evaluates a form. Returns a pointer to the runtime value."""
+        # Leave the session as it was if the form does not compile,
+        # so later forms never refer to anything that is not defined.
+        snapshot = self.snapshot()
+        try:
+            module, name = self.compile(form)
+            mod = compile_module(str(module), self.level)
+            check_symbols(mod)
+        except Exception:
+            self.restore(snapshot)
+            raise
+        finalize_module(self.engine, mod)
+        fn = ctypes.CFUNCTYPE(ctypes.c_void_p)(
+            self.engine.get_function_address(name))
+        return fn()
+
+    def show(self, value):
+        self.print_value(value)
+        self.fflush(None)
+        print()
+
+    def run(self, source, show=False):
+        """Evaluates all forms in source."""
+        _, ast = parse(source)
+        ast, _ = simplify(ast)
+        for form in ast:
+            value = self.eval(form)
+            if show:
+                self.show(value)
+
+def check_symbols(mod):
+    """
+    Raises for functions the module declares which the process does
+    not define, as calling them would jump to address 0.
+    """
+    for fn in mod.functions:
+        if (fn.is_declaration and not fn.name.startswith('llvm.')
+                and not llvm.address_of_symbol(fn.name)):
+            raise Exception('Could not resolve symbol ' + fn.name)
+
+def read(fp=sys.stdin):
+    """
+    Reads lines until they parse as complete forms. Returns None at
+    the end of input.
+    """
+    lines = []
+    while True:
+        prompt = CONTINUATION if lines else PROMPT
+        if fp.isatty():
+            try:
+                line = input(prompt)
+            except EOFError:
+                return None
+        else:
+            line = fp.readline()
+            if not line:
+                return None
+        lines.append(line)
+        source = '\n'.join(lines)
+        try:
+            parse(source)
+        except Exception as e:
+            if 'EOF' in str(e):
+                continue
+            raise
+        return source
+
+def repl(runtime, level='0', load=None):
+    """Runs a REPL, after evaluating the source file load if given."""
+    session = Session(runtime, level)
+    if load:
+        with open(load, 'r') as fp:
+            session.run(fp.read())
+    while True:
+        try:
+            source = read()
+            if source is None:
+                break
+            session.run(source, show=True)
+        except KeyboardInterrupt:
+            print()
+        except Exception as e:
+            print('error: {}'.format(e), file=sys.stderr)
+    timer.report()
@@ -0,0 +1,97 @@
+"""
+Call resolution.
+
+Finds the functions a call is known to reach at compile time, so it
+can be a direct call instead of going through a boxed function value,
+and which of those are pure, so calls to them can be evaluated at
+compile time.
+"""
+from lang.nodes import NIL, TRUE, FALSE, List, Literal, Symbol, head
+from lang.simplify import NATIVE_OPS
+
+def definitions(ast):
+    """Yields (name, form) for every def & defun in a program."""
+    stack = list(ast)
+    while stack:
+        form = stack.pop()
+        if not isinstance(form, List):
+            continue
+        if (head(form) in ['def', 'defun'] and 2 <= len(form)
+                and isinstance(form[1], Symbol)):
+            yield form[1].name, form
+        stack.extend(form)
+
+def static_functions(ast):
+    """
+    Returns a dict of name to arity for all globals which are defined
+    by a defun, and nothing else, so they always hold that function.
+    """
+    forms = dict()
+    for name, form in definitions(ast):
+        forms.setdefault(name, []).append(form)
+    return {name: len(defs[0][2]) for name, defs in forms.items()
+            if 1 == len(defs)
+            and 'defun' == head(defs[0])
+            and 4 <= len(defs[0])
+            and isinstance(defs[0][2], List)}
+
+def is_pure(form, local, pure):
+    """
+    Whether form only uses literals, the local names, native ops,
+    control flow & calls to the pure functions, a dict of name to
+    arity.
+    """
+    if isinstance(form, Literal) or form in [NIL, TRUE, FALSE]:
+        return True
+    if isinstance(form, Symbol):
+        return form.name in local
+    name = head(form)
+    if name is None or name in local:
+        return False
+    args = form[1:]
+    if name in NATIVE_OPS:
+        return 2 == len(args) and all(is_pure(a, local, pure) for a in args)
+    if 'if' == name:
+        return 3 == len(args) and all(is_pure(a, local, pure) for a in args)
+    if name in ['progn', 'recur']:
+        return all(is_pure(a, local, pure) for a in args)
+    if 'let' == name:
+        if 2 > len(args) or not isinstance(args[0], List):
+            return False
+        bindings = args[0]
+        if not all(isinstance(b, List) and 2 == len(b)
+                   and isinstance(b[0], Symbol) for b in bindings):
+            return False
+        # Binding values are evaluated in the outer scope.
+        inner = local | set(b[0].name for b in bindings)
+        return (all(is_pure(b[1], local, pure) for b in bindings)
+                and all(is_pure(a, inner, pure) for a in args[1:]))
+    if name in pure:
+        return (pure[name] == len(args)
+                and all(is_pure(a, local, pure) for a in args))
+    return False
+
+def pure_functions(ast):
+    """
+    Returns a dict of name to defun form for all static functions
+    which are pure: they only compute their result from their
+    arguments, without FFI calls, globals or function values, so
+    calling them has no effects & they always return the same value.
+    """
+    functions = static_functions(ast)
+    forms = {name: form for name, form in definitions(ast)
+             if name in functions}
+    pure = dict(functions)
+    # Assume all are pure, until they call something which is not.
+    changed = True
+    while changed:
+        changed = False
+        for name in list(pure):
+            form = forms[name]
+            params = form[2]
+            if not (all(isinstance(p, Symbol) for p in params)
+                    and all(is_pure(f, set(p.name for p in params), pure)
+                            for f in form[3:])):
+                del pure[name]
+                changed = True
+    return {name: forms[name] for name in pure}
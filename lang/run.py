@@ -0,0 +1,41 @@
+"""
+Running programs in-process.
+
+Instead of writing an object file & linking it against the runtime,
+the compiled module is added to an MCJIT engine and its user code is
+called straight away, with the runtime loaded into the process as a
+shared library, see the libnebula.so make target.
+
+The runtime's main can't be used, as the shared library does not see
+symbols defined in the JIT, so we do what it does ourselves. Unless
+the runtime is linked into the module, see lang.llvm.link_runtime, in
+which case it is all in the JIT and main just works.
+"""
+import ctypes
+
+from lang.debug import timer
+from lang.llvm import llvm, compile_execution_engine, finalize_module
+
+def run(mod, runtime, argv):
+    """
+    Runs the compiled module with the runtime shared library at path
+    runtime and the given program arguments. Returns the exit status.
+    """
+    linked = any('nebula_main' == fn.name and not fn.is_declaration
+                 for fn in mod.functions)
+    if not linked:
+        llvm.load_library_permanently(runtime)
+    engine = compile_execution_engine()
+    finalize_module(engine, mod)
+    entry = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int,
+                             ctypes.POINTER(ctypes.c_char_p))(
+        engine.get_function_address('main' if linked else 'usercode_main'))
+    args = [arg.encode('utf8') for arg in argv]
+    c_argv = (ctypes.c_char_p * (len(args) + 1))(*args, None)
+    if not linked:
+        ctypes.CFUNCTYPE(None)(llvm.address_of_symbol('init_nebula'))()
+    with timer.phase('run'):
+        status = entry(len(args), c_argv)
+        # The program writes through C's stdio, not Python's.
+        ctypes.CDLL(None).fflush(None)
+    return status
@@ -0,0 +1,167 @@
+"""
+The compile server.
+
+Starting lang costs more than compiling a short file: importing
+llvmlite, initialising LLVM & creating target machines. The server
+pays for that once, in a pool of worker processes which stay warm,
+and accepts compile requests on a Unix socket.
+
+A request is the client's working directory & its lang arguments, as
+a line of JSON. A worker runs the same build as the lang command,
+writing its output files itself, and the reply is the exit status &
+whatever the build printed to stderr. Requests are served
+concurrently, one per worker at a time.
+
+langc is the client, taking the same arguments as lang. It compiles
+in-process if there is no server running.
+"""
+import argparse
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr
+
+from lang import conf
+
+def default_socket():
+    return os.path.join(tempfile.gettempdir(),
+                        '{}-{}'.format(os.getuid(), conf.SERVER_SOCKET))
+
+_target_machines = dict()
+
+def init_worker():
+    """Pays the start-up costs once per worker."""
+    from lang.llvm import init_llvm
+    init_llvm()
+
+def compile_request(cwd, argv):
+    """
+    Runs a build in a worker. Returns a tuple of (exit status,
+    stderr output).
+    """
+    from lang import build, parse_args
+    from lang.debug import timer
+    from lang.llvm import compile_target_machine
+    stderr = io.StringIO()
+    with redirect_stderr(stderr):
+        try:
+            # Workers only ever run one build at a time.
+            os.chdir(cwd)
+            args = parse_args(argv)
+            if args.time_phases:
+                timer.enable()
+            if args.opt_level not in _target_machines:
+                _target_machines[args.opt_level] = \
+                    compile_target_machine(args.opt_level)
+            build(args, _target_machines[args.opt_level])
+            # report binds the real stderr as its default.
+            timer.report(sys.stderr)
+            status = 0
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            timer.reset()
+    return status, stderr.getvalue()
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        try:
+            status, stderr = self.server.pool.submit(
+                compile_request, request['cwd'], request['argv']).result()
+        except BrokenProcessPool:
+            # A worker died, most likely in LLVM. Start over with a
+            # fresh pool for the next request.
+            self.server.restart_pool()
+            status, stderr = 1, 'error: compile server worker crashed\n'
+        reply = {'status': status, 'stderr': stderr}
+        self.wfile.write(json.dumps(reply).encode('utf8') + b'\n')
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, workers):
+        self.workers = workers
+        self.pool = None
+        self.restart_pool()
+        super().__init__(path, Handler)
+
+    def restart_pool(self):
+        if self.pool:
+            self.pool.shutdown(wait=False)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                        initializer=init_worker)
+
+def serve(path, workers):
+    """Serves compile requests on the Unix socket at path."""
+    if os.path.exists(path):
+        os.unlink(path)
+    # Clean up on kill as well as on ^C.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with Server(path, workers) as server:
+        print('lang-server: listening on {} with {} workers'.format(
+            path, workers), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.pool.shutdown()
+            os.unlink(path)
+
+def main():
+    parser = argparse.ArgumentParser(prog='lang-server')
+    parser.add_argument('--socket', default=default_socket(),
+                        help='Unix socket to listen on (default: %(default)s)')
+    parser.add_argument('-w', '--workers', type=int,
+                        default=os.cpu_count() or 1,
+                        help='compile this many requests at once '
+                        '(default: %(default)s)')
+    args = parser.parse_args()
+    serve(args.socket, args.workers)
+
+def request(path, argv):
+    """
+    Sends a compile request to the server. Returns the reply, or None
+    if there is no server.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    with sock, sock.makefile('rwb') as fp:
+        request = {'cwd': os.getcwd(), 'argv': argv}
+        fp.write(json.dumps(request).encode('utf8') + b'\n')
+        fp.flush()
+        return json.loads(fp.readline())
+
+def client():
+    """langc, which takes the same arguments as lang."""
+    from lang import parse_args
+    parser = argparse.ArgumentParser(prog='langc', add_help=False)
+    parser.add_argument('--socket',
+                        default=os.environ.get('LANG_SERVER_SOCKET',
+                                               default_socket()))
+    args, argv = parser.parse_known_args()
+    # Catches usage errors before bothering the server.
+    parsed = parse_args(argv)
+    if parsed.repl or parsed.run:
+        parser.error('programs do not run on the compile server')
+    reply = request(args.socket, argv)
+    if reply is None:
+        from lang import main
+        sys.argv[1:] = argv
+        return main()
+    sys.stderr.write(reply['stderr'])
+    sys.exit(reply['status'])
@@ -0,0 +1,50 @@
+"""
+Whole-program dead code elimination.
+
+Top-level expressions are always run, so they are the roots, along
+with globals whose value has effects to compute. Every def & defun
+the roots do not refer to, directly or through other definitions, is
+dropped. Names are resolved by symbol only, so a local shadowing a
+global keeps the global alive, which is safe.
+
+FFI declarations are kept, as the compiler calls some of them itself.
+Unused ones cost nothing once compiled, see minimise_module.
+"""
+from lang.nodes import Symbol, head
+from lang.resolve import is_pure
+from lang.units import symbols
+
+def definition_name(form):
+    """Returns the name a top-level form defines, or None."""
+    if (head(form) in ['def', 'defun'] and 2 <= len(form)
+            and isinstance(form[1], Symbol)):
+        return form[1].name
+    return None
+
+def drop_unreachable(ast):
+    """
+    Returns the program without definitions which are never used,
+    and how many top-level forms were dropped.
+    """
+    definitions = dict()
+    reached = set()
+    stack = []
+    for form in ast:
+        name = definition_name(form)
+        if name is None or ('def' == head(form) and 3 == len(form)
+                            and not is_pure(form[2], set(), dict())):
+            stack.append(form)
+        if name is not None:
+            definitions.setdefault(name, []).append(form)
+    kept = set()
+    while stack:
+        form = stack.pop()
+        if id(form) in kept:
+            continue
+        kept.add(id(form))
+        for name in symbols(form):
+            if name not in reached:
+                reached.add(name)
+                stack.extend(definitions.get(name, []))
+    shaken = [form for form in ast if id(form) in kept]
+    return shaken, len(ast) - len(shaken)
@@ -0,0 +1,232 @@
+"""
+Simplification of the AST between parsing & compilation.
+
+Folds arithmetic & comparisons on literals, prunes if branches with a
+constant condition, inlines let bindings to literals and drops side
+effect free expressions whose values are never used.
+"""
+import operator
+
+from lang.debug import debug
+from lang.nodes import (NIL, TRUE, FALSE, Char, Float, Int, Keyword, List,
+                        Str, Symbol, head)
+
+ARITHMETIC_OPS = ['+', '-', '*', '/']
+COMPARISON_OPS = ['<', '<=', '==', '!=', '>=', '>']
+NATIVE_OPS = ARITHMETIC_OPS + COMPARISON_OPS
+
+ARITHMETIC = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+}
+
+COMPARISONS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '>': operator.gt,
+}
+
+def count_nodes(forms):
+    n = 0
+    stack = list(forms)
+    while stack:
+        form = stack.pop()
+        n += 1
+        if isinstance(form, List):
+            stack.extend(form.items)
+    return n
+
+def is_inlinable(atom):
+    """
+    Literals which are cheap to duplicate. Strings are not, as every
+    occurrence would be a new runtime value.
+    """
+    return (isinstance(atom, (Int, Float, Char, Keyword))
+            or atom in [NIL, TRUE, FALSE])
+
+def truthiness(atom):
+    """
+    Returns whether a literal is truthy, following the runtime's
+    value_truthy, or None if atom is not a literal.
+    """
+    if isinstance(atom, (Int, Float)):
+        return 0 < atom.value
+    if atom in [NIL, FALSE]:
+        return False
+    if atom is TRUE:
+        return True
+    if isinstance(atom, Str):
+        return '' != atom.value
+    if isinstance(atom, (Char, Keyword)):
+        return True
+    return None
+
+def wrap_i64(n):
+    """Wraps like native 64-bit signed integer maths."""
+    n &= (1 << 64) - 1
+    return n - (1 << 64) if n >= (1 << 63) else n
+
+def fold_native_op(op, a, b, span=None):
+    """
+    Returns the literal result of a native op on two number literals,
+    or None if it can't be folded.
+    """
+    if op in COMPARISON_OPS:
+        return TRUE if COMPARISONS[op](a, b) else FALSE
+    if isinstance(a, float) or isinstance(b, float):
+        a, b = float(a), float(b)
+        if '/' == op and 0 == b:
+            return None
+        return Float(ARITHMETIC[op](a, b), span)
+    if '/' == op:
+        if 0 == b:
+            return None
+        # Native division truncates towards zero.
+        quotient = abs(a) // abs(b)
+        return Int(wrap_i64(quotient if (a < 0) == (b < 0) else -quotient), span)
+    return Int(wrap_i64(ARITHMETIC[op](a, b)), span)
+
+def is_pure(form):
+    """Whether evaluating form is free of side effects."""
+    if not isinstance(form, List):
+        return True
+    return (3 == len(form)
+            and head(form) in NATIVE_OPS
+            and is_pure(form[1])
+            and is_pure(form[2]))
+
+def rebuild(form, items):
+    """Returns form with new items, or form itself if none changed."""
+    if all(map(operator.is_, form.items, items)):
+        return form
+    return List(items, form.span)
+
+def names(forms):
+    """The names of the symbols in forms."""
+    return [f.name for f in forms if isinstance(f, Symbol)]
+
+def substitute(form, bindings):
+    """Replaces symbols in form by literals, respecting shadowing."""
+    if not bindings:
+        return form
+    if isinstance(form, Symbol):
+        return bindings.get(form.name, form)
+    if not isinstance(form, List) or not form:
+        return form
+    name = head(form)
+    if 'declare' == name:
+        return form
+    if 'def' == name and 3 == len(form):
+        return List([form[0], form[1], substitute(form[2], bindings)], form.span)
+    if 'let' == name and 2 <= len(form) and isinstance(form[1], List):
+        bound = names(b[0] for b in form[1] if isinstance(b, List) and b)
+        # Binding values are evaluated in the outer scope.
+        new_bindings = [List(b[:1] + tuple(substitute(v, bindings) for v in b[1:]), b.span)
+                        if isinstance(b, List) and b else b
+                        for b in form[1]]
+        inner = {k: v for k, v in bindings.items() if k not in bound}
+        return List([form[0], List(new_bindings, form[1].span)]
+                    + [substitute(f, inner) for f in form[2:]], form.span)
+    if 'lambda' == name and 2 <= len(form) and isinstance(form[1], List):
+        inner = {k: v for k, v in bindings.items() if k not in names(form[1])}
+        return List(form[:2] + tuple(substitute(f, inner) for f in form[2:]),
+                    form.span)
+    if 'defun' == name and 3 <= len(form) and isinstance(form[2], List):
+        inner = {k: v for k, v in bindings.items() if k not in names(form[2])}
+        return List(form[:3] + tuple(substitute(f, inner) for f in form[3:]),
+                    form.span)
+    return rebuild(form, [substitute(f, bindings) for f in form.items])
+
+def simplify_body(forms):
+    """
+    Simplifies an implicit progn, dropping side effect free forms
+    which are not in tail position. Returns a Python list.
+    """
+    forms = [simplify_form(f) for f in forms]
+    return [f for f in forms[:-1] if not is_pure(f)] + forms[-1:]
+
+def simplify_let(form):
+    if 2 > len(form) or not isinstance(form[1], List):
+        return form
+    bindings = form[1]
+    if not all(isinstance(b, List) and 2 == len(b)
+               and isinstance(b[0], Symbol) for b in bindings):
+        # Leave it for the compiler to complain about.
+        return form
+    bound = names(b[0] for b in bindings)
+    kept = []
+    inlined = dict()
+    for binding in bindings:
+        name, value = binding
+        value = simplify_form(value)
+        if is_inlinable(value) and 1 == bound.count(name.name):
+            inlined[name.name] = value
+        else:
+            kept.append(List([name, value], binding.span))
+    body = simplify_body([substitute(f, inlined) for f in form[2:]])
+    if kept:
+        return List([form[0], List(kept, bindings.span)] + body, form.span)
+    if 1 == len(body):
+        return body[0]
+    return List([Symbol('progn')] + body, form.span)
+
+def simplify_form(form):
+    if not isinstance(form, List) or not form:
+        return form
+    name = head(form)
+    if 'declare' == name:
+        return form
+    if 'lambda' == name and 2 <= len(form):
+        return List(list(form[:2]) + simplify_body(form[2:]), form.span)
+    if 'defun' == name and 3 <= len(form):
+        return List(list(form[:3]) + simplify_body(form[3:]), form.span)
+    if 'def' == name and 3 == len(form):
+        return List([form[0], form[1], simplify_form(form[2])], form.span)
+    if 'progn' == name:
+        body = simplify_body(form[1:])
+        return body[0] if 1 == len(body) else List([form[0]] + body, form.span)
+    if 'let' == name:
+        return simplify_let(form)
+    if 'if' == name and 4 == len(form):
+        condition = simplify_form(form[1])
+        truthy = truthiness(condition)
+        if truthy is None:
+            return List([form[0], condition] + [simplify_form(f) for f in form[2:]],
+                        form.span)
+        return simplify_form(form[2] if truthy else form[3])
+    form = rebuild(form, [simplify_form(f) for f in form.items])
+    if name in NATIVE_OPS and 3 == len(form):
+        a, b = form[1], form[2]
+        if isinstance(a, (Int, Float)) and isinstance(b, (Int, Float)):
+            return fold_native_op(name, a.value, b.value, form.span) or form
+    return form
+
+def simplify(ast):
+    """
+    Simplifies a whole program.
+    Returns a tuple of (AST, number of nodes removed).
+    """
+    before = count_nodes(ast)
+    ast = simplify_body(ast)
+    removed = before - count_nodes(ast)
+    debug('simplify removed', removed, 'nodes')
+    return ast, removed
+
+def simplify_forms(forms):
+    """
+    Simplifies a program form by form, as it is parsed. Yields the
+    same forms simplify would return, holding one back to know if it
+    is the last.
+    """
+    previous = None
+    for form in forms:
+        if previous is not None and not is_pure(previous):
+            yield previous
+        previous = simplify_form(form)
+    if previous is not None:
+        yield previous
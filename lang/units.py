@@ -0,0 +1,406 @@
+"""
+Incremental compilation.
+
+Every top-level form is compiled into its own LLVM module (a unit),
+which defines a single function evaluating the form. Units only see
+declarations of the globals & FFI functions defined by earlier forms.
+A small main module defines those globals and calls the units in
+order.
+
+Units can be compiled & optimised in parallel, in a pool of worker
+processes, as each one only needs the declarations.
+
+Units are content-addressed: the key is a hash of the form and of the
+forms defining anything it refers to, so compiled bitcode can be
+cached on disk and reused as long as none of those changed.
+"""
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from lang import conf
+from lang.compiler import (Environment, compile_runtime_declarations,
+                           compile_entry_points, compile_declare,
+                           compile_expression, compile_nil)
+from lang.debug import timer
+from lang.llvm import *
+from lang.nodes import List, Symbol, head
+from lang.resolve import definitions as all_definitions, static_functions
+
+def _compiler_digest():
+    """Hash of the compiler source, so upgrades invalidate the cache."""
+    digest = hashlib.sha256()
+    directory = os.path.dirname(__file__)
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.py'):
+            with open(os.path.join(directory, name), 'rb') as fp:
+                digest.update(fp.read())
+    return digest.hexdigest()
+
+COMPILER_DIGEST = _compiler_digest()
+
+def serialise(form):
+    """A canonical string representation of a form."""
+    return str(form)
+
+def symbols(form):
+    """Yields the names of all symbols in a form."""
+    stack = [form]
+    while stack:
+        form = stack.pop()
+        if isinstance(form, List):
+            stack.extend(form)
+        elif isinstance(form, Symbol):
+            yield form.name
+
+def definitions(form):
+    """
+    Yields (kind, name, form) for everything a form defines, which is
+    either a 'global' from def & defun, or an FFI 'declare'.
+    """
+    stack = [form]
+    while stack:
+        form = stack.pop()
+        if not isinstance(form, List):
+            continue
+        if 'declare' == head(form):
+            yield 'declare', form[1].name, form
+        elif head(form) in ['def', 'defun']:
+            yield 'global', form[1].name, form
+        stack.extend(form)
+
+# User-declared functions the compiler itself emits calls to.
+IMPLICIT_REFERENCES = {'value_truthy'}
+
+def global_name(name):
+    """
+    The symbol of a global in units, which are linked as they are, so
+    they must not clash with the runtime's symbols.
+    """
+    return 'global.' + name
+
+def unit_name(key):
+    return 'unit_' + key[:16]
+
+class Unit:
+    """A top-level form, and everything needed to compile it alone."""
+    def __init__(self, form, key, declares, globals_, functions, memo):
+        self.form = form
+        self.key = key
+        self.declares = declares
+        self.globals = globals_
+        # Static functions it may call directly, name -> arity.
+        self.functions = functions
+        # Functions it defines to memoise -> lookup table.
+        self.memo = memo
+
+    @property
+    def name(self):
+        return unit_name(self.key)
+
+class Interface:
+    """
+    Tracks what earlier forms define, to split a program into units.
+    Static functions are known for the whole program up front, so
+    units can call functions defined by later forms directly.
+    """
+    def __init__(self, functions=None, memo=None):
+        self.functions = functions or dict()
+        self.memo = memo or dict()
+        self.declares = dict()
+        self.globals = {'argv'}
+        # name -> digest of the defining form
+        self.defined_by = dict()
+
+    def add(self, form):
+        """Returns the unit for the next top-level form."""
+        digest = hashlib.sha256(serialise(form).encode('utf8')).hexdigest()
+        defined = list(definitions(form))
+        referenced = set(symbols(form)) | IMPLICIT_REFERENCES
+        deps = sorted(set(self.defined_by[name] for name in referenced
+                          if name in self.defined_by))
+        functions = {name: argc for name, argc in self.functions.items()
+                     if name in referenced}
+        deps += sorted('{}/{}'.format(name, argc)
+                       for name, argc in functions.items())
+        memo = {name: self.memo[name] for kind, name, _ in defined
+                if name in self.memo}
+        deps += sorted('memo {} {}'.format(name, table)
+                       for name, table in memo.items())
+        key = hashlib.sha256(
+            ' '.join([COMPILER_DIGEST, digest] + deps).encode('utf8')
+        ).hexdigest()
+        declares = [self.declares[name] for name in sorted(referenced)
+                    if name in self.declares]
+        globals_ = sorted((referenced & self.globals) |
+                          set(name for kind, name, _ in defined
+                              if 'global' == kind))
+        for kind, name, definition in defined:
+            if 'declare' == kind:
+                self.declares[name] = definition
+            else:
+                self.globals.add(name)
+            self.defined_by[name] = digest
+        return Unit(form, key, declares, globals_, functions, memo)
+
+def compile_unit(unit, name=None):
+    """
+    Compiles a unit into a module of its own, with a single function
+    that evaluates the form & returns its value. The function is
+    named after the unit, unless a name is given.
+    """
+    name = name or unit.name
+    module = ir.Module(name=name)
+    module.triple = llvm.get_default_triple()
+    fn = ir.Function(module, ir.FunctionType(T_VALUE_STRUCT_PTR, []),
+                     name=name)
+    env = Environment(module, fn.append_basic_block('entry'))
+    env.static_functions = unit.functions
+    env.memo = unit.memo
+    compile_runtime_declarations(env)
+    for declaration in unit.declares:
+        compile_declare(env, declaration)
+    for name in unit.globals:
+        # Defined in the main module.
+        env.global_scope[name] = ir.GlobalVariable(
+            module, T_VALUE_STRUCT_PTR, global_name(name))
+    retval = compile_expression(env, unit.form)
+    if retval is None:
+        retval = compile_nil(env, None)
+    env.builder.ret(env.box(retval))
+    return module
+
+def compile_units_main(names, globals_):
+    """
+    Compiles the main module, which defines all globals and calls the
+    units, by name, in order.
+    """
+    module = ir.Module(name='main')
+    module.triple = llvm.get_default_triple()
+    env, argv = compile_entry_points(module)
+    for name in sorted(globals_):
+        gv = ir.GlobalVariable(module, T_VALUE_STRUCT_PTR, global_name(name))
+        gv.initializer = ir.Constant(T_VALUE_STRUCT_PTR, None)
+    env.builder.store(argv, module.get_global(global_name('argv')))
+    unit_type = ir.FunctionType(T_VALUE_STRUCT_PTR, [])
+    for name in names:
+        try:
+            fn = module.get_global(name)
+        except KeyError:
+            fn = ir.Function(module, unit_type, name=name)
+        env.builder.call(fn, [])
+    env.builder.ret(T_I32(0))
+    return module
+
+class Cache:
+    """Compiled unit bitcode on disk, by unit key."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.bc')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as fp:
+                bitcode = fp.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return bitcode
+
+    def put(self, key, bitcode):
+        # Write & rename, so concurrent builds never see partial files.
+        tmp = '{}.{}.tmp'.format(self.path(key), os.getpid())
+        with open(tmp, 'wb') as fp:
+            fp.write(bitcode)
+        os.replace(tmp, self.path(key))
+
+_target_machines = dict()
+
+def compile_unit_module(unit, level='0'):
+    """Compiles & optimises a unit. Returns the module object."""
+    if level not in _target_machines:
+        init_llvm()
+        _target_machines[level] = compile_target_machine(level)
+    mod = llvm.parse_assembly(str(compile_unit(unit)))
+    mod.data_layout = str(_target_machines[level].target_data)
+    mod.verify()
+    return optimise_module(mod, level)
+
+def compile_unit_bitcode(unit, level='0'):
+    """
+    Compiles & optimises a unit. Returns bitcode, which unlike modules
+    can be passed between processes.
+    """
+    return compile_unit_module(unit, level).as_bitcode()
+
+def compile_bitcodes(units, level='0', jobs=1):
+    """
+    Compiles units to bitcode, in a pool of jobs worker processes if
+    more than one. Returns a list of bitcodes, in order.
+    """
+    if 1 == jobs or len(units) < 2:
+        return [compile_unit_bitcode(unit, level) for unit in units]
+    # Batch up units, but leave enough batches to balance the load.
+    chunksize = max(1, len(units) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(compile_unit_bitcode, units,
+                             [level] * len(units), chunksize=chunksize))
+
+def compile_units(ast, cache=None, level='0', jobs=1, memo=None):
+    """
+    Compiles a program unit by unit, reusing cached units where
+    possible, and links them with the main module. memo is as for
+    compiler.compile_main. Returns the linked module object, which
+    still needs lang.llvm.optimise_linked.
+    """
+    interface = Interface(static_functions(ast), memo)
+    units = [interface.add(form) for form in ast]
+    with timer.phase('compile units'):
+        bitcodes = dict()
+        missing = dict()
+        for unit in units:
+            cache_key = '{}-O{}'.format(unit.key, level)
+            if unit.key in bitcodes or unit.key in missing:
+                continue
+            bitcode = cache.get(cache_key) if cache else None
+            if bitcode is None:
+                missing[unit.key] = unit
+            bitcodes[unit.key] = bitcode
+        compiled = compile_bitcodes(list(missing.values()), level, jobs)
+        for unit, bitcode in zip(missing.values(), compiled):
+            bitcodes[unit.key] = bitcode
+            if cache:
+                cache.put('{}-O{}'.format(unit.key, level), bitcode)
+    timer.count('units', len(bitcodes))
+    if cache:
+        timer.count('cache hits', cache.hits)
+        timer.count('cache misses', cache.misses)
+    with timer.phase('link'):
+        mod = llvm.parse_assembly(str(compile_units_main(
+            [unit.name for unit in units], interface.globals)))
+        for bitcode in bitcodes.values():
+            mod.link_in(llvm.parse_bitcode(bitcode))
+    return mod
+
+class StreamInterface(Interface):
+    """
+    An interface for forms as they are parsed, when the whole program
+    is not known up front. Functions become static once defined, so
+    only later forms call them directly, which means they can never
+    be redefined.
+    """
+    def add(self, form):
+        names = [name for name, _ in all_definitions([form])]
+        for name in names:
+            if name in self.functions:
+                raise Exception('{} is redefined, which streaming '
+                                'compilation does not support'.format(name))
+        for name, argc in static_functions([form]).items():
+            if name not in self.defined_by:
+                self.functions[name] = argc
+        return super().add(form)
+
+class Linker:
+    """
+    Links many modules into one. Linking into a module takes longer
+    the bigger it is, so modules are merged like a binary counter,
+    pairing up ones of the same size, which copies every module only
+    a logarithmic number of times.
+    """
+    def __init__(self):
+        self.stack = []
+
+    def add(self, mod):
+        size = 1
+        while self.stack and self.stack[-1][0] == size:
+            other_size, other = self.stack.pop()
+            other.link_in(mod)
+            mod, size = other, size + other_size
+        self.stack.append((size, mod))
+
+    def module(self):
+        """Returns the linked module. Needs at least one."""
+        _, mod = self.stack.pop()
+        while self.stack:
+            _, other = self.stack.pop()
+            other.link_in(mod)
+            mod = other
+        return mod
+
+def batches(forms, size):
+    """
+    Groups forms into progns of up to size forms, as every unit has
+    a fixed cost on top of its forms.
+    """
+    batch = []
+    for form in forms:
+        batch.append(form)
+        if size == len(batch):
+            yield List([Symbol('progn')] + batch)
+            batch = []
+    if batch:
+        yield List([Symbol('progn')] + batch)
+
+def compile_stream(forms, cache=None, level='0', jobs=1):
+    """
+    Compiles a program as its forms arrive, from a generator, in units
+    of conf.STREAM_FORMS forms, linking each one as soon as it is
+    compiled, so memory does not grow with the AST. With jobs, units
+    compile in worker processes while the next forms are parsed.
+    Returns the linked module object, as compile_units does.
+    """
+    interface = StreamInterface()
+    linker = Linker()
+    names = []
+    compiled = set()
+    pending = []
+    pool = ProcessPoolExecutor(max_workers=jobs) if 1 < jobs else None
+
+    def add_bitcode(key, bitcode):
+        """Links a unit newly compiled in a worker."""
+        if cache:
+            cache.put('{}-O{}'.format(key, level), bitcode)
+        linker.add(llvm.parse_bitcode(bitcode))
+
+    with timer.phase('compile stream'):
+        try:
+            for form in batches(forms, conf.STREAM_FORMS):
+                unit = interface.add(form)
+                names.append(unit.name)
+                if unit.key in compiled:
+                    continue
+                compiled.add(unit.key)
+                cache_key = '{}-O{}'.format(unit.key, level)
+                bitcode = cache.get(cache_key) if cache else None
+                if bitcode is not None:
+                    linker.add(llvm.parse_bitcode(bitcode))
+                elif pool:
+                    pending.append((unit.key, pool.submit(
+                        compile_unit_bitcode, unit, level)))
+                elif cache:
+                    add_bitcode(unit.key, compile_unit_bitcode(unit, level))
+                else:
+                    linker.add(compile_unit_module(unit, level))
+                # Link what is done, and wait if parsing is far ahead.
+                while pending and (pending[0][1].done()
+                                   or jobs * 4 < len(pending)):
+                    key, future = pending.pop(0)
+                    add_bitcode(key, future.result())
+            for key, future in pending:
+                add_bitcode(key, future.result())
+        finally:
+            if pool:
+                pool.shutdown()
+    timer.count('units', len(compiled))
+    with timer.phase('link'):
+        main = llvm.parse_assembly(str(compile_units_main(
+            names, interface.globals)))
+        linker.add(main)
+        mod = linker.module()
+    return mod
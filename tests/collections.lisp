@@ -0,0 +1,35 @@
+;; This tests that vector & hash map literals work.
+
+(declare print_value void (value))
+(declare value_equal value (value value))
+(declare value_get value (value value))
+(declare value_assoc value (value value value))
+(declare value_count value (value))
+
+(def v [1 "two" :three [4]])
+(print_value v)
+(print_value "\n")
+(print_value (value_get v 1))
+(print_value "\n")
+(print_value (value_get v 4))
+(print_value "\n")
+(print_value (value_assoc v 4 5))
+(print_value "\n")
+
+;; The last of duplicate keys wins.
+(def m {:a 1 "b" 2 3 [4] :a 5})
+(print_value (value_count m))
+(print_value "\n")
+(print_value (value_get m :a))
+(print_value "\n")
+(print_value (value_get m "b"))
+(print_value "\n")
+(print_value (value_get m :c))
+(print_value "\n")
+
+;; Literals of values only known at runtime.
+(defun point (x y) {:x x :y y})
+(print_value (value_equal (point 1 2) {:y 2 :x 1}))
+(print_value "\n")
+(print_value (value_get (value_assoc (point 1 2) :z 3) :z))
+(print_value "\n")
@@ -2,3 +2,22 @@
 
 (print_value (+ 40 2))
 (print_value "\n")
+
+;; Function arguments are runtime values, so whether they are ints or
+;; floats is only known at runtime.
+(defun half (x) (/ x 2.0))
+(defun add (a b) (+ a b))
+(defun less (a b) (< a b))
+
+(print_value (half 5))
+(print_value "\n")
+(print_value (add 1.5 2.25))
+(print_value "\n")
+(print_value (add 1 2))
+(print_value "\n")
+(print_value (add 1 2.5))
+(print_value "\n")
+(print_value (less 2 1.5))
+(print_value "\n")
+(print_value (+ (add 1 2) 0.5))
+(print_value "\n")
@@ -0,0 +1,22 @@
+import pytest
+
+from lang import parse_args
+
+@pytest.mark.parametrize('argv', [
+    ['prog.lisp', '--run', 'a', 'b'],
+    ['--run', 'prog.lisp', 'a', 'b'],
+    ['--run', 'prog.lisp', '--', 'a', 'b'],
+])
+def test_program_args(argv):
+    args = parse_args(argv)
+    assert 'prog.lisp' == args.source_file
+    assert ['a', 'b'] == args.program_args
+
+def test_dash_program_args():
+    args = parse_args(['prog.lisp', '--run', '--', '-v', '--', 'a'])
+    assert ['-v', '--', 'a'] == args.program_args
+    assert not args.repl
+
+def test_program_args_need_run():
+    with pytest.raises(SystemExit):
+        parse_args(['prog.lisp', 'a'])
@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# The runtime shared library, see the libnebula.so make target.
+RUNTIME = os.path.abspath(os.environ.get('NEBULA_RUNTIME', 'libnebula.so'))
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run(source, flags, tmp_path):
+    if not os.path.exists(RUNTIME):
+        pytest.skip('needs the runtime, run make libnebula.so')
+    path = tmp_path / 'prog.lisp'
+    path.write_text('(declare print_value void (value))\n' + source)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run(
+        [sys.executable, '-c', 'import lang; lang.main()', *flags,
+         '--run', str(path), '--runtime', RUNTIME],
+        cwd=tmp_path, env=env, capture_output=True, text=True, check=True
+    ).stdout
+
+@pytest.mark.parametrize('flags', [[], ['-O2'], ['--stream'], ['-j', '2']])
+def test_redefined_defun(flags, tmp_path):
+    source = '''
+    (defun f (x) (+ x 1))
+    (print_value (f 10))
+    (defun f (x) (+ x 2))
+    (print_value (f 10))
+    (defun g (x y) (* x y))
+    (defun g (x) x)
+    (print_value (g 5))
+    '''
+    assert '11125' == run(source, flags, tmp_path)
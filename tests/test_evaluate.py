@@ -0,0 +1,42 @@
+import os
+import time
+
+import pytest
+
+from lang import conf
+from lang.evaluate import evaluate
+from lang.parser import parse
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'),
+                                reason='evaluation needs fork')
+
+COUNT = '(defun count (n) (if (< n 1) 0 (count (- n 1))))'
+
+def evaluated(source):
+    _, ast = parse(source)
+    ast, replaced = evaluate(ast)
+    return ' '.join(str(form) for form in ast[1:]), replaced
+
+def test_folds_pure_calls():
+    assert ('(print 16)', 1) == evaluated('(defun sq (x) (* x x)) (print (sq 4))')
+
+def test_leaves_calls_with_unknown_arguments():
+    assert ('(print (sq x))', 0) == evaluated('(defun sq (x) (* x x)) (print (sq x))')
+
+def test_leaves_calls_out_of_fuel(monkeypatch):
+    monkeypatch.setattr(conf, 'EVALUATE_STEPS', 1000)
+    # Calls after the one which ran out of fuel are still evaluated.
+    assert (('(print (count 100000)) (print 0)', 1)
+            == evaluated(COUNT + ' (print (count 100000)) (print (count 10))'))
+
+def test_leaves_calls_out_of_time(monkeypatch):
+    monkeypatch.setattr(conf, 'EVALUATE_STEPS', 1 << 62)
+    monkeypatch.setattr(conf, 'EVALUATE_TIMEOUT', 0.5)
+    start = time.monotonic()
+    assert (('(print (spin 1))', 0)
+            == evaluated('(defun spin (x) (recur x)) (print (spin 1))'))
+    assert 0.5 <= time.monotonic() - start < 5
+
+def test_disabled_without_timeout(monkeypatch):
+    monkeypatch.setattr(conf, 'EVALUATE_TIMEOUT', 0)
+    assert ('(print (count 10))', 0) == evaluated(COUNT + ' (print (count 10))')
@@ -0,0 +1,36 @@
+import io
+
+import pytest
+
+from lang.parser import parse, parse_forms
+
+SOURCE = '''; A comment (with parens) "and quotes"
+(defun greet (name)
+  (print "hello, \\"world\\" (" name ")"))
+(print \\newline \\space \\tab \\a \\( \\;)
+(print [1 2.5 -3 :key] {:a "b" :c [\\newline]})
+(greet "unicode → ünïcödé")  ; trailing comment
+symbol-at-the-end'''
+
+def forms(ast):
+    return [(str(form), getattr(form, 'span', None)) for form in ast]
+
+@pytest.mark.parametrize('size', list(range(1, 24)) + [len(SOURCE), 1 << 16])
+def test_chunks_match_whole_source(size):
+    _, ast = parse(SOURCE)
+    assert forms(ast) == forms(parse_forms(io.StringIO(SOURCE), size))
+
+@pytest.mark.parametrize('source', [
+    '(print "unterminated',
+    '(print (f 1)',
+    '(print 1))',
+    '(print [1 2)',
+    '(print \\',
+])
+@pytest.mark.parametrize('size', [1, 3, 1 << 16])
+def test_chunks_raise_like_whole_source(source, size):
+    with pytest.raises(Exception) as whole:
+        parse(source)
+    with pytest.raises(Exception) as chunked:
+        list(parse_forms(io.StringIO(source), size))
+    assert str(whole.value) == str(chunked.value)
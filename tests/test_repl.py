@@ -0,0 +1,33 @@
+import ctypes
+import os
+
+import pytest
+
+from lang.parser import parse
+from lang.repl import Session
+
+# The runtime shared library, see the libnebula.so make target.
+RUNTIME = os.path.abspath(os.environ.get('NEBULA_RUNTIME', 'libnebula.so'))
+
+@pytest.fixture
+def session():
+    if not os.path.exists(RUNTIME):
+        pytest.skip('needs the runtime, run make libnebula.so')
+    return Session(RUNTIME)
+
+def value_type(value):
+    return ctypes.cast(value, ctypes.POINTER(ctypes.c_int))[0]
+
+def test_argv_is_nil(session):
+    session.run('(declare car value (value))')
+    _, ast = parse('(car argv)')
+    assert 0 == value_type(session.eval(ast[0]))
+
+def test_unresolved_declare(session):
+    with pytest.raises(Exception, match='no_such_function'):
+        session.run('(declare no_such_function value ())\n'
+                    '(no_such_function)')
+    # The session is left as it was.
+    session.run('(def x 42)')
+    _, ast = parse('x')
+    assert 2 == value_type(session.eval(ast[0]))
@@ -0,0 +1,43 @@
+import pytest
+
+from lang.parser import parse
+from lang.simplify import simplify, simplify_forms
+
+def simplified(source):
+    _, ast = parse(source)
+    ast, _ = simplify(ast)
+    return ' '.join(str(form) for form in ast)
+
+@pytest.mark.parametrize('source, expected', [
+    ('(f (+ 1 (* 2 3)))', '(f 7)'),
+    ('(f (/ 7 -2))', '(f -3)'),
+    ('(f (/ 1 2.0))', '(f 0.5)'),
+    ('(f (< 1 2))', '(f true)'),
+    # Division by zero is left for runtime.
+    ('(f (/ 1 0))', '(f (/ 1 0))'),
+    ('(f (+ x 1))', '(f (+ x 1))'),
+])
+def test_folding(source, expected):
+    assert expected == simplified(source)
+
+def test_if_with_constant_condition():
+    assert '(f 1)' == simplified('(if (< 1 2) (f 1) (f 2))')
+
+def test_let_inlining():
+    assert '(f 3)' == simplified('(let ((x 1)) (f (+ x 2)))')
+
+def test_shadowing():
+    assert ('(f 1 (lambda (x) x) (defun g (x) x))'
+            == simplified('(let ((x 1)) (f x (lambda (x) x) (defun g (x) x)))'))
+    # Inner let values see the outer binding, bodies the inner one.
+    assert ('(let ((x (g 1))) (f x))'
+            == simplified('(let ((x 1)) (let ((x (g x))) (f x)))'))
+
+def test_drops_unused_pure_forms():
+    assert '(f)' == simplified('(+ 1 2) (f)')
+
+def test_forms_match_whole_program():
+    source = '(+ 1 2) (def x (* 2 3)) (f x) (+ x 1)'
+    _, ast = parse(source)
+    assert ([str(form) for form in simplify(ast)[0]]
+            == [str(form) for form in simplify_forms(ast)])
@@ -0,0 +1,45 @@
+from lang.llvm import llvm
+from lang.parser import parse
+from lang.simplify import simplify
+from lang.units import Cache, compile_units
+
+def program(source):
+    _, ast = parse(source)
+    ast, _ = simplify(ast)
+    return ast
+
+def compile_cached(source, cache):
+    cache.hits = cache.misses = 0
+    compile_units(program(source), cache)
+    return cache.hits, cache.misses
+
+def test_cache_hits_and_misses(tmp_path):
+    cache = Cache(str(tmp_path))
+    source = '(def a 1) (def b a) (def c 3)'
+    assert (0, 3) == compile_cached(source, cache)
+    assert (3, 0) == compile_cached(source, cache)
+
+def test_cache_invalidates_dependents(tmp_path):
+    cache = Cache(str(tmp_path))
+    compile_cached('(def a 1) (def b a) (def c 3)', cache)
+    # b refers to a, so both are compiled again, c is not.
+    assert (1, 2) == compile_cached('(def a 2) (def b a) (def c 3)', cache)
+
+def test_globals_do_not_clash_with_runtime():
+    # type is also a runtime function, which the output is linked with.
+    mod = compile_units(program('(def type 5) (def x type)'))
+    names = [gv.name for gv in mod.global_variables]
+    assert 'global.type' in names
+    assert 'type' not in names
+
+def test_defuns_named_like_lambdas():
+    mod = compile_units(program(
+        '(defun lambda0 (x) x) (lambda0 ((lambda (y) y) 1))'))
+    assert llvm.Linkage.external == mod.get_function('fn_lambda0').linkage
+
+def test_parallel_globals_do_not_clash_with_runtime():
+    mod = compile_units(program('(def type 5) (def x type) (def y x)'),
+                        jobs=2)
+    names = [gv.name for gv in mod.global_variables]
+    assert 'global.type' in names
+    assert 'type' not in names